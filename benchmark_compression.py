@@ -0,0 +1,115 @@
+# benchmark_compression.py
+#
+# How much compressing the game's messages saves on the wire, and what it
+# costs in CPU per tick, with and without a preset dictionary.
+#
+# Train a dictionary and benchmark with it:
+#   python benchmark_compression.py --train game.dict
+#   python benchmark_compression.py --dictionary game.dict
+#
+# Then run the game with it:
+#   python example_game_server.py --compress --compressDictionary game.dict
+#   python fake_client.py --compress --compressDictionary game.dict
+#
+import argparse
+import random
+import time
+from example_game_server import PacketProtocol, PacketId, PlayerClient
+from message import Compressor, train_dictionary, zstandard
+
+ARGS = argparse.ArgumentParser(description="Compression benchmark")
+ARGS.add_argument('--players', action="store", dest="players", default="32", help="Players in the simulated game.")
+ARGS.add_argument('--ticks', action="store", dest="ticks", default="300", help="Ticks of traffic to benchmark.")
+ARGS.add_argument('--threshold', action="store", dest="threshold", default="64", help="Messages shorter than this aren't compressed.")
+ARGS.add_argument('--dictionary', action="store", dest="dictionary", default="", help="Preset dictionary to benchmark.")
+ARGS.add_argument('--train', action="store", dest="train", default="", help="Train a dictionary and save it to this file.")
+ARGS.add_argument('--dictionarySize', action="store", dest="dictionarySize", default="4096", help="Size of the trained dictionary.")
+
+
+def game_traffic(players, ticks, seed):
+    """ The messages one client gets over `ticks` ticks of a game with
+        `players` players wandering around and shooting, as sent by the
+        game server. Returns a list of ticks, each a list of messages.
+    """
+    rng = random.Random(seed)
+    random.seed(seed)
+    protocol = PacketProtocol()
+    clients = [PlayerClient(i + 1, None) for i in range(players)]
+    bullets = []
+    traffic = []
+    for tick in range(ticks):
+        messages = []
+        moved = []
+        for player in clients:
+            if rng.random() < 0.05:
+                player.set_movement([rng.randrange(-1, 2), rng.randrange(-1, 2)])
+            if player.movement != [0, 0]:
+                player.position[0] += player.movement[0] * player.speed / 60
+                player.position[1] += player.movement[1] * player.speed / 60
+                moved.append(player.as_dict())
+            if rng.random() < 0.01:
+                bullets.append([list(player.position), list(player.facing), 60])
+        if moved:
+            messages.append(protocol.create(PacketId.PLAYER_UPDATES, protocol.pack_data(moved), tick))
+
+        bullets = [b for b in bullets if b[2] > 0]
+        if bullets:
+            update = []
+            for bullet in bullets:
+                bullet[0][0] += bullet[1][0] * 20 / 60
+                bullet[0][1] += bullet[1][1] * 20 / 60
+                bullet[2] -= 1
+                update.append({"position": [int(bullet[0][0] * 1000), int(bullet[0][1] * 1000)],
+                               "rotation": 0})
+            messages.append(protocol.create(PacketId.BULLETS, protocol.pack_data(update), tick))
+        traffic.append(messages)
+    return traffic
+
+
+def run(name, compressor, traffic):
+    raw = sum(len(message) for tick in traffic for message in tick)
+    start = time.perf_counter()
+    compressed = [[compressor.compress(message) for message in tick] for tick in traffic]
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for tick in compressed:
+        for message in tick:
+            compressor.decompress(message)
+    decompress_time = time.perf_counter() - start
+
+    wire = sum(len(message) for tick in compressed for message in tick)
+    ticks = len(traffic)
+    print("{:>14}: {:7.0f} bytes/tick ({:5.1f}%)  compress {:7.2f}us/tick  decompress {:7.2f}us/tick".format(
+        name, wire / ticks, wire / raw * 100, compress_time / ticks * 1e6, decompress_time / ticks * 1e6))
+
+
+if __name__ == '__main__':
+    args = ARGS.parse_args()
+    players = int(args.players)
+    ticks = int(args.ticks)
+    threshold = int(args.threshold)
+
+    if args.train:
+        # a different game than the one we benchmark against
+        samples = [message for tick in game_traffic(players, ticks * 4, seed=1) for message in tick]
+        dictionary = train_dictionary(samples, int(args.dictionarySize))
+        with open(args.train, 'wb') as f:
+            f.write(dictionary)
+        print("Trained a {} byte dictionary on {} messages, saved to {}".format(len(dictionary), len(samples), args.train))
+    elif args.dictionary:
+        with open(args.dictionary, 'rb') as f:
+            dictionary = f.read()
+    else:
+        dictionary = b''
+
+    traffic = game_traffic(players, ticks, seed=2)
+    raw = sum(len(message) for tick in traffic for message in tick)
+    print("{} players, {} ticks, {:.0f} bytes/tick uncompressed".format(players, ticks, raw / ticks))
+
+    run("zlib", Compressor(threshold=threshold), traffic)
+    if dictionary:
+        run("zlib+dict", Compressor(dictionary, threshold=threshold), traffic)
+    if zstandard is not None:
+        run("zstd", Compressor(threshold=threshold, level=3, method='zstd'), traffic)
+        if dictionary:
+            run("zstd+dict", Compressor(dictionary, threshold=threshold, level=3, method='zstd'), traffic)
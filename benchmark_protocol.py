@@ -0,0 +1,38 @@
+# benchmark_protocol.py
+#
+# Compares encoding/decoding cost and size of the JSON MessageProtocol and
+# the BinaryProtocol for a typical player update message.
+#
+import argparse
+import timeit
+from message import MessageProtocol, BinaryProtocol
+
+ARGS = argparse.ArgumentParser(description="Message protocol benchmark")
+ARGS.add_argument(
+    '--count',
+    action="store",
+    dest="count",
+    default='200000',
+    help='How many messages to encode and decode per protocol.')
+
+
+def run(name, protocol, payload, count):
+    msg = protocol.create('player_update', payload)
+    create_time = timeit.timeit(lambda: protocol.create('player_update', payload), number=count)
+    parse_time = timeit.timeit(lambda: protocol.parse(msg), number=count)
+    print("{:>8}: {:3d} bytes  create {:6.3f}us  parse {:6.3f}us".format(
+        name, len(msg), create_time / count * 1e6, parse_time / count * 1e6))
+
+
+if __name__ == '__main__':
+    args = ARGS.parse_args()
+    count = int(args.count)
+
+    # player id, x, y, facing x, facing y
+    payload = [42, 12.5, -3.25, 1, 0]
+
+    binary = BinaryProtocol()
+    binary.register('player_update', 1, 'Iffbb', ('uuid', 'x', 'y', 'facing_x', 'facing_y'))
+
+    run("json", MessageProtocol(), payload, count)
+    run("binary", binary, payload, count)
@@ -0,0 +1,257 @@
+# Packet capture
+#
+# Records every datagram a server receives and sends into a compact binary
+# log, and replays the received ones into a server later without any real
+# sockets, to reproduce and profile problems offline (see replay.py).
+#
+# A capture is a series of segment files, <path>.0000, <path>.0001, ...
+# Each segment is preallocated and memory-mapped, so recording a datagram
+# is a copy into memory, not a system call. When a segment is full the next
+# one is started and, past `max_segments`, the oldest is deleted. Starting a
+# capture deletes any segments left at the same path by an earlier one.
+#
+# Every segment starts with MAGIC, followed by records:
+#
+#   time (double, from the server's clock), flags (byte), port (uint16), data length (uint16),
+#   address (4 bytes, or 16 for IPv6), data
+#
+# Preallocated space is zeros, and a record's flags always have VALID set,
+# so a reader stops at the first record without it, even if the writer
+# never got to close the file.
+#
+import glob
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+from server import HANDSHAKE
+
+MAGIC = b"UDPCAP01"
+RECORD = struct.Struct("<dBHH")
+VALID = 0x80
+OUTBOUND = 0x01
+IPV6 = 0x02
+
+
+def segment_name(path, index):
+    return "{}.{:04d}".format(path, index)
+
+
+def capture_segments(path):
+    """ The segment files of a capture, oldest first. """
+    names = [name for name in glob.glob(glob.escape(path) + ".*") if name.rsplit(".", 1)[1].isdigit()]
+    return sorted(names, key=lambda name: int(name.rsplit(".", 1)[1]))
+
+
+class CaptureWriter:
+    """ Appends datagrams to a rotating, memory-mapped capture.
+
+        Set it as a server's `capture` to record everything the server
+        receives and sends, stamped with the server's clock (virtual time
+        on a loopback network). Safe to use from many threads.
+
+        A new capture replaces any earlier one at the same path: its
+        segments are deleted first, so they can't be read back after the
+        new records.
+    """
+    def __init__(self, path, segment_size=64 * 1024 * 1024, max_segments=8):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.records = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._map = None
+        self._offset = 0
+        self._index = -1
+        for name in capture_segments(path):
+            os.remove(name)
+        self._open_segment()
+
+    def _open_segment(self):
+        self._close_segment()
+        self._index += 1
+        self._file = open(segment_name(self.path, self._index), "w+b")
+        self._file.truncate(self.segment_size)
+        self._map = mmap.mmap(self._file.fileno(), self.segment_size)
+        self._map[:len(MAGIC)] = MAGIC
+        self._offset = len(MAGIC)
+
+        old = self._index - self.max_segments
+        if old >= 0:
+            try:
+                os.remove(segment_name(self.path, old))
+            except OSError:
+                pass
+
+    def _close_segment(self):
+        if self._map is None:
+            return
+        self._map.flush()
+        self._map.close()
+        # drop the unused, preallocated tail
+        self._file.truncate(self._offset)
+        self._file.close()
+        self._map = None
+        self._file = None
+
+    def inbound(self, address, data, now):
+        self._record(0, address, data, now)
+
+    def outbound(self, address, data, now):
+        self._record(OUTBOUND, address, data, now)
+
+    def _record(self, direction, address, data, now):
+        try:
+            host = socket.inet_aton(address[0])
+            flags = VALID | direction
+        except OSError:
+            host = socket.inet_pton(socket.AF_INET6, address[0])
+            flags = VALID | direction | IPV6
+        length = len(data)
+        size = RECORD.size + len(host) + length
+        with self._lock:
+            if self._map is None or size > self.segment_size - len(MAGIC):
+                self.dropped += 1
+                return
+            if self._offset + size > self.segment_size:
+                self._open_segment()
+            offset = self._offset
+            RECORD.pack_into(self._map, offset, now, flags, address[1], length)
+            offset += RECORD.size
+            self._map[offset:offset + len(host)] = host
+            offset += len(host)
+            self._map[offset:offset + length] = data
+            self._offset = offset + length
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+
+def read_capture(path):
+    """ Yields (time, outbound, address, data) for every record of a
+        capture, oldest first.
+    """
+    for name in capture_segments(path):
+        with open(name, "rb") as f:
+            segment = f.read()
+        if segment[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a capture".format(name))
+        offset = len(MAGIC)
+        end = len(segment)
+        while offset + RECORD.size <= end:
+            timestamp, flags, port, length = RECORD.unpack_from(segment, offset)
+            if not flags & VALID:
+                break
+            offset += RECORD.size
+            if flags & IPV6:
+                host = socket.inet_ntop(socket.AF_INET6, segment[offset:offset + 16])
+                offset += 16
+            else:
+                host = socket.inet_ntoa(segment[offset:offset + 4])
+                offset += 4
+            data = segment[offset:offset + length]
+            offset += length
+            yield timestamp, bool(flags & OUTBOUND), (host, port), data
+
+
+class DiscardSocket:
+    """ Stands in for a server's socket during a replay. Nothing is sent;
+        the server's own metrics still count what would have been.
+    """
+    def sendto(self, data, address):
+        return len(data)
+
+    def getsockname(self):
+        return ("replay", 0)
+
+    def setblocking(self, flag):
+        pass
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        pass
+
+
+def offline_server(server_class):
+    """ A server of `server_class` that has no real socket, for replay(). """
+    return server_class(("127.0.0.1", 0), transport=DiscardSocket())
+
+
+class ReplayStats:
+    def __init__(self):
+        self.inbound = 0
+        self.recorded_outbound = 0
+        self.ticks = 0
+        self.duration = 0.0
+        self.wall_time = 0.0
+
+
+def replay(records, server, speed=1.0, tick=None, tick_rate=60):
+    """ Feeds the inbound datagrams of a capture into `server` (from
+        offline_server()) on this thread, the way a BatchUDPServer would.
+
+        `speed` is how much faster than real time to go: 1 is the original
+        timing, 10 is ten times as fast and 0 is as fast as possible. If
+        `tick` is given it is called `tick_rate` times per second of
+        captured time, in between the datagrams that arrived around it.
+        The server's clock is set to the captured time, so heartbeats and
+        resends happen when they did, whatever the speed.
+        Returns a ReplayStats.
+    """
+    stats = ReplayStats()
+    now = [0.0]
+    server.clock = lambda: now[0]
+    interval = 1.0 / tick_rate
+    start_wall = time.perf_counter()
+    first = None
+    next_tick = None
+
+    def wait_until(timestamp):
+        if speed > 0:
+            delay = (timestamp - first) / speed - (time.perf_counter() - start_wall)
+            if delay > 0:
+                time.sleep(delay)
+
+    timestamp = None
+    for timestamp, outbound, address, data in records:
+        if first is None:
+            first = next_tick = timestamp
+        # sent datagrams aren't replayed, but the game keeps ticking
+        # through them
+        while tick is not None and next_tick <= timestamp:
+            wait_until(next_tick)
+            now[0] = next_tick
+            tick(interval)
+            server.service_actions()
+            stats.ticks += 1
+            next_tick += interval
+
+        if outbound:
+            stats.recorded_outbound += 1
+            continue
+        if data[:1] == bytes((HANDSHAKE,)):
+            # the cookies were made with another server's secret
+            continue
+
+        wait_until(timestamp)
+        now[0] = timestamp
+        request = (data, server.socket)
+        try:
+            if server.verify_request(request, address):
+                server.finish_request(request, address)
+        except Exception:
+            server.handle_error(request, address)
+        stats.inbound += 1
+
+    if first is not None:
+        stats.duration = timestamp - first
+    stats.wall_time = time.perf_counter() - start_wall
+    return stats
@@ -0,0 +1,169 @@
+# Entity store
+#
+# Keeps positions, velocities, lifetimes and owners of many entities in
+# contiguous NumPy arrays (structure of arrays), so moving, clamping and
+# expiring them is a handful of vectorized operations per tick instead of a
+# Python loop over objects.
+#
+# NumPy is optional; it's only needed if an EntityStore is created.
+#
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# cell (x, y) -> x * _CELL_KEY + y, unique while |y| < _CELL_KEY / 2
+_CELL_KEY = 1 << 32
+
+
+class EntityStore:
+    def __init__(self, capacity=256):
+        if np is None:
+            raise RuntimeError("EntityStore needs numpy, `pip install numpy`")
+
+        self.count = 0
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.position = np.zeros((capacity, 2), dtype=np.float64)
+        self.velocity = np.zeros((capacity, 2), dtype=np.float64)
+        self.lifetime = np.full(capacity, np.inf, dtype=np.float64)
+        self.owner = np.full(capacity, -1, dtype=np.int64)
+
+        # entity id -> row
+        self._rows = {}
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, entity_id):
+        return entity_id in self._rows
+
+    def _grow(self):
+        capacity = len(self.ids) * 2
+        for name in ('ids', 'position', 'velocity', 'lifetime', 'owner'):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def add(self, entity_id, position, velocity=(0, 0), lifetime=float('inf'), owner=-1):
+        if self.count == len(self.ids):
+            self._grow()
+        row = self.count
+        self.ids[row] = entity_id
+        self.position[row] = position
+        self.velocity[row] = velocity
+        self.lifetime[row] = lifetime
+        self.owner[row] = owner
+        self._rows[entity_id] = row
+        self.count += 1
+        return row
+
+    def row(self, entity_id):
+        return self._rows[entity_id]
+
+    def remove(self, entity_id):
+        """ Swap-remove: the last row moves into the hole. """
+        row = self._rows.pop(entity_id)
+        last = self.count - 1
+        if row != last:
+            self.ids[row] = self.ids[last]
+            self.position[row] = self.position[last]
+            self.velocity[row] = self.velocity[last]
+            self.lifetime[row] = self.lifetime[last]
+            self.owner[row] = self.owner[last]
+            self._rows[int(self.ids[row])] = row
+        self.count = last
+
+    def integrate(self, dt, bounds=None):
+        """ position += velocity * dt for every entity, optionally clamped
+            to bounds ((min x, min y), (max x, max y)).
+        """
+        n = self.count
+        position = self.position[:n]
+        position += self.velocity[:n] * dt
+        if bounds is not None:
+            np.clip(position, bounds[0], bounds[1], out=position)
+
+    def expire(self, dt):
+        """ Counts lifetimes down and compacts out every entity whose
+            lifetime ran out. Returns their ids.
+        """
+        n = self.count
+        lifetime = self.lifetime[:n]
+        lifetime -= dt
+        return self.remove_rows(lifetime <= 0)
+
+    def remove_rows(self, mask):
+        """ Removes every row where `mask` is true, keeping the order of
+            the rest. Returns the removed ids.
+        """
+        dead = np.flatnonzero(mask)
+        if len(dead) == 0:
+            return []
+        dead_ids = self.ids[dead].tolist()
+        keep = np.flatnonzero(~mask)
+        for name in ('ids', 'position', 'velocity', 'lifetime', 'owner'):
+            array = getattr(self, name)
+            array[:len(keep)] = array[keep]
+        self.count = len(keep)
+
+        for entity_id in dead_ids:
+            del self._rows[entity_id]
+        # only rows that actually moved need their index fixed
+        moved = np.flatnonzero(keep != np.arange(len(keep)))
+        for row, entity_id in zip(moved.tolist(), self.ids[moved].tolist()):
+            self._rows[entity_id] = row
+        return dead_ids
+
+    def hits(self, targets, radius):
+        """ Rows of this store within `radius` of any entity in `targets`
+            (another EntityStore) that they don't own. Returns
+            (rows hit, id of the target each one hit).
+
+            Targets are binned into cells `radius` wide, so only pairs in
+            neighbouring cells get the exact distance test.
+        """
+        n = self.count
+        m = targets.count
+        if n == 0 or m == 0 or radius <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        target_cells = np.floor(targets.position[:m] / radius).astype(np.int64)
+        target_keys = target_cells[:, 0] * _CELL_KEY + target_cells[:, 1]
+        order = np.argsort(target_keys, kind='stable')
+        sorted_keys = target_keys[order]
+
+        cells = np.floor(self.position[:n] / radius).astype(np.int64)
+        all_rows = np.arange(n)
+        rows = []
+        columns = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                keys = (cells[:, 0] + dx) * _CELL_KEY + cells[:, 1] + dy
+                first = np.searchsorted(sorted_keys, keys, 'left')
+                counts = np.searchsorted(sorted_keys, keys, 'right') - first
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+                # every (row, target) pair in that cell
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                rows.append(np.repeat(all_rows, counts))
+                columns.append(order[np.repeat(first, counts) + offsets])
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        rows = np.concatenate(rows)
+        columns = np.concatenate(columns)
+
+        delta = self.position[rows] - targets.position[columns]
+        close = np.einsum('ij,ij->i', delta, delta) <= radius * radius
+        # you can't hit yourself
+        close &= self.owner[rows] != targets.ids[columns]
+        rows = rows[close]
+        columns = columns[close]
+        # each row hits the first target it's close to
+        pairs = np.lexsort((columns, rows))
+        rows = rows[pairs]
+        columns = columns[pairs]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = rows[1:] != rows[:-1]
+        return rows[first], targets.ids[columns[first]]
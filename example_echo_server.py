@@ -1,9 +1,10 @@
-from server import ThreadedUDPServer
+from server import EventServer
+# from server import AsyncEventServer as EventServer
 import threading
 
 
 # Create the server instance and assign the binding address for it
-server = ThreadedUDPServer(('localhost', 9999))
+server = EventServer(('localhost', 9999))
 
 
 # Set up a few example event handlers
@@ -2,28 +2,49 @@
 #
 # This is a simple game server for a silly "game".
 # from server import ThreadedUDPServer
-from server import EventServer
+from server import EventServer, ReliableSender, TickScheduler, serve_metrics
+from server import TokenBucketLimiter, CookieHandshake, BufferPool, Inbox
+from capture import CaptureWriter
+# from server import AsyncEventServer as EventServer
+# from server import BatchedEventServer as EventServer
 import threading
 import random
 import time
 import json
-from message import MessageProtocol
-from enum import Enum
+from message import MessageProtocol, BroadcastMessage, Compressor
+from replication import SnapshotReplicator
+from spatial import SpatialHashGrid
+from entities import EntityStore, np
+from enum import IntEnum
 import msgpack
-import sys
+import struct
 import argparse
+import math
 
-lock = threading.Lock()
+# sequence numbers wrap around after this
+MAX_SEQUENCE_NUMBER = 10000
 
+# sequence numbers in broadcasts are packed as a big-endian msgpack uint16
+SEQUENCE_NUMBER = struct.Struct(">H")
 
-class PacketId(Enum):
+
+def sequence_more_recent(s1, s2, max_sequence=MAX_SEQUENCE_NUMBER):
+    """ True if sequence number s1 comes after s2, allowing for wrap around. """
+    return (s1 > s2 and s1 - s2 <= max_sequence / 2) or (s2 > s1 and s2 - s1 > max_sequence / 2)
+
+
+class PacketId(IntEnum):
     JOIN = 0
     WELCOME = 1
     ACK = 2
+    ACK_BITS = 4
     HEARTBEAT = 3
+    COMPRESSION = 5
     PLAYER_INFO = 10
     PLAYER_UPDATES = 11
     PLAYER_LEFT = 12
+    SNAPSHOT = 13
+    SNAPSHOT_ACK = 14
     PLAYER_INPUT = 20
     PLAYER_FIRE = 21
     WORLD_INFO = 30
@@ -31,15 +52,30 @@ class PacketId(Enum):
 
 
 class PacketProtocol(MessageProtocol):
+    # set to a Compressor to accept compressed packets
+    compressor = None
+
     def create(self, msg_type, payload, sequence_number=0, needs_ack=False):
         message = [msg_type.value, sequence_number, 1 if needs_ack else 0, payload]
         packed = msgpack.packb(message)
         return packed
 
-    def parse(self, message):        
-        unpacked = msgpack.unpackb(message)
-        unpacked[0] = PacketId(int(unpacked[0]))
-        return unpacked
+    def create_broadcast(self, msg_type, payload):
+        """ Packs the message once for every recipient of a broadcast.
+            The sequence number is always written as a msgpack uint16 so it
+            can be patched in place for each recipient.
+        """
+        packet_id = msgpack.packb(msg_type.value)
+        header = b'\x94' + packet_id + b'\xcd\x00\x00'
+        template = header + b'\x00' + msgpack.packb(payload)
+        return BroadcastMessage(template, len(header) - 2, SEQUENCE_NUMBER, len(header))
+
+    def parse(self, message):
+        if self.compressor is not None:
+            message = self.compressor.decompress(message)
+        # the packet id stays a plain int: PacketId is an IntEnum, so it
+        # still compares equal and indexes the server's dispatch table
+        return msgpack.unpackb(message)
 
     def pack_data(self, data):
         return msgpack.packb(data, encoding='utf-8')
@@ -48,9 +84,83 @@ class PacketProtocol(MessageProtocol):
         return msgpack.unpackb(data, encoding='utf-8')
 
 
+class InputBuffer:
+    """ Jitter buffer for one player's inputs.
+
+        Clients stamp every input with a sequence number and their tick,
+        and send each one a few times. The buffer keeps them in sequence
+        order, drops duplicates and anything older than the last input
+        applied, and hands out exactly one per simulation tick.
+
+        It waits until `delay` inputs are queued before it starts, so inputs
+        that arrive in bursts still come out one per tick. When it runs dry
+        next() returns None (keep doing what you were doing); only after
+        `delay` dry ticks in a row does it wait for `delay` inputs again,
+        so one late input doesn't add latency. When it backs up past
+        `delay * 2` the oldest are skipped, so the player's latency can't
+        keep growing.
+    """
+    def __init__(self, delay=2, max_sequence=MAX_SEQUENCE_NUMBER):
+        self.delay = delay
+        self.max_sequence = max_sequence
+        # (sequence, client tick, movement), oldest first
+        self._inputs = []
+        self._waiting = True
+        self._dry_ticks = 0
+        # sequence and client tick of the last input applied
+        self.last_sequence = None
+        self.last_tick = None
+        self.stale = 0
+        self.skipped = 0
+        self.starved = 0
+
+    def __len__(self):
+        return len(self._inputs)
+
+    def add(self, sequence, tick, movement):
+        """ Returns False if the input was a duplicate or too old. """
+        if self.last_sequence is not None and not sequence_more_recent(sequence, self.last_sequence, self.max_sequence):
+            self.stale += 1
+            return False
+        inputs = self._inputs
+        i = len(inputs)
+        while i > 0 and sequence_more_recent(inputs[i - 1][0], sequence, self.max_sequence):
+            i -= 1
+        if i > 0 and inputs[i - 1][0] == sequence:
+            return False
+        inputs.insert(i, (sequence, tick, movement))
+        return True
+
+    def next(self):
+        """ The movement to apply this tick, or None. """
+        inputs = self._inputs
+        if self._waiting:
+            if len(inputs) < max(self.delay, 1):
+                return None
+            self._waiting = False
+        if not inputs:
+            self.starved += 1
+            self._dry_ticks += 1
+            if self._dry_ticks >= max(self.delay, 1):
+                self._waiting = True
+                self._dry_ticks = 0
+            return None
+        self._dry_ticks = 0
+        while len(inputs) > max(self.delay * 2, 1):
+            self._apply(inputs.pop(0))
+            self.skipped += 1
+        return self._apply(inputs.pop(0))
+
+    def _apply(self, item):
+        self.last_sequence, self.last_tick, movement = item
+        return movement
+
+
 class PlayerClient:
     """ Server-side representation of every connected player. """
-    def __init__(self, player_id, client_addr):
+    SNAPSHOT_FIELDS = ("colorRed", "colorGreen", "colorBlue", "x", "y")
+
+    def __init__(self, player_id, client_addr, input_delay=2):
         self.uuid = player_id
         self.color = (
             random.uniform(0.0, 1.0),
@@ -66,10 +176,32 @@ class PlayerClient:
         # Player's current input, stored as <x> and <y> deltas
         self.movement = [0, 0]
 
+        # stamped inputs waiting to be applied, one per tick
+        self.inputs = InputBuffer(input_delay)
+
         # which direction is the player "facing" 
         # (aka, which way did he move last)
         self.facing = [1, 0]        
 
+        # whether messages to this player are compressed, see
+        # GameServer.negotiate_compression()
+        self.compress = False
+
+        # whether the last BULLETS update sent to this player had anything
+        # in it, so it gets told when the last visible bullet is gone
+        self.saw_bullets = False
+
+    def snapshot(self):
+        """ Quantized state for snapshot replication, in SNAPSHOT_FIELDS
+            order. Same precision as as_dict().
+        """
+        return (
+            int(self.color[0] * 255),
+            int(self.color[1] * 255),
+            int(self.color[2] * 255),
+            int(self.position[0] * 1000),
+            int(self.position[1] * 1000))
+
     def set_movement(self, move):
         self.movement = move
         if move[0] != 0 or move[1] != 0:
@@ -89,20 +221,13 @@ class PlayerClient:
             "colorBlue": int(self.color[2] * 255),
             "position": (int(self.position[0] * 1000), int(self.position[1] * 1000))
         }
+        if self.inputs.last_sequence is not None:
+            # the last input applied, so the client can reconcile its
+            # predicted position with this one
+            data["input"] = self.inputs.last_sequence
         return data
 
 
-class PacketInfo:
-    def __init__(self, seq_number, sent_at, target, event, payload):        
-        self.sent_ticks = sent_at
-        self.sequence_number = seq_number
-        # id of the target player
-        self.target = target
-        # this is so we can send it again if needed
-        self.payload = payload
-        self.event = event
-
-
 class World:
     """ Server-side representation of the game world. """
     def __init__(self, size=(20, 10)):
@@ -117,14 +242,23 @@ class World:
         }
 
 
+def bullet_rotation(direction):
+    """ Which way a bullet is flying, in degrees. """
+    return math.degrees(math.atan2(direction[1], direction[0]))
+
+
 class Bullet:
     """ Server-side representation of a bullet object. """
+    SPEED = 8
+    LIFETIME = 2.0
+
     def __init__(self, pos, direct, created_by):
         self.position = pos
         self.direction = direct
-        self.speed = 8
+        self.speed = Bullet.SPEED
         self.owner = created_by
-        self.lifetime = 2.0
+        self.lifetime = Bullet.LIFETIME
+        self.rotation = bullet_rotation(direct)
 
     def as_dict(self):
         return {
@@ -135,9 +269,13 @@ class Bullet:
 
 class GameServer:
     def __init__(self, settings):
+        # All game state is owned by the tick thread. Network handlers only
+        # decode packets and put commands in the inbox, which every tick
+        # drains before simulating.
+        self._inbox = Inbox()
+
         self._clients = {}
         self._socket_to_player = {}
-        self._clients_to_remove = []
         self._player_id_number = 0
 
         # Binding Address
@@ -147,8 +285,9 @@ class GameServer:
         self._server_thread = None
 
         self._sequence_number = 0
-        self._max_sequence_number = 10000
-        self._ack_needed = []
+        self._max_sequence_number = MAX_SEQUENCE_NUMBER
+        # packets waiting for an ack, resent until they get one
+        self._reliable = ReliableSender(max_sequence=self._max_sequence_number + 1)
 
         self.protocol = PacketProtocol()
 
@@ -159,16 +298,92 @@ class GameServer:
         # game tick rate, in frames per second.
         self._tick_rate = int(settings.tickRate)
 
-        # stats
+        # fixed update tick
+        self._scheduler = TickScheduler(self._tick_rate)
+
+        # pack everything a player gets in one tick into as few datagrams
+        # as possible
+        self._coalesce = settings.coalesce
+
+        # how many ticks of stamped input to buffer per player
+        self._input_delay = int(settings.inputDelay)
+
+        # compress messages to players that asked for it (COMPRESSION)
+        self._compressor = None
+        if settings.compress:
+            dictionary = b''
+            if settings.compressDictionary:
+                with open(settings.compressDictionary, 'rb') as f:
+                    dictionary = f.read()
+            self._compressor = Compressor(dictionary)
+
+        # split messages bigger than one datagram into fragments
+        self._fragment = settings.fragment
+
+        # send SNAPSHOT deltas instead of full PLAYER_UPDATES
+        self._delta_snapshots = settings.deltaSnapshots
+        self._replicator = SnapshotReplicator(PlayerClient.SNAPSHOT_FIELDS)
+
+        # area of interest: players only get updates about things within
+        # this many units of them. 0 sends everything to everyone.
+        self._interest_radius = float(settings.interestRadius)
+        cell_size = self._interest_radius if self._interest_radius > 0 else 10
+        self._player_grid = SpatialHashGrid(cell_size)
+        self._bullet_grid = SpatialHashGrid(cell_size)
+
+        # keep player and bullet physics in NumPy arrays instead of objects
+        self._use_entity_store = settings.entityStore
+        if self._use_entity_store:
+            self._player_store = EntityStore()
+            self._bullet_store = EntityStore()
+            self._bullet_id_number = 0
+            # bullets fired since the last tick: (position, direction, owner)
+            self._fired = []
+            # how close a bullet has to get to a player to hit them
+            self._hit_radius = 0.5
+
+        # stats, printed every _stat_time seconds
         self._stat_timer = 5
         self._stat_time = 5
-        self._stat_sent = 0
-        self._stat_sent_bandwidth = 0
+        self._stat_last_sent = 0
+        self._stat_last_bytes = 0
 
-    def start(self):
-        self._socket_server = EventServer(self._server_address)
+        # serve Prometheus metrics on this port, 0 to turn off
+        self._metrics_port = int(settings.metricsPort)
+
+        # flood protection: datagrams per second per address (0 is
+        # unlimited), and whether clients must handshake before joining
+        self._rate_limit = float(settings.rateLimit)
+        self._handshake = settings.handshake
+
+        # receive into preallocated buffers instead of a new bytes per packet
+        self._buffer_pool = settings.bufferPool
+
+        # record all traffic to this capture, for replay.py
+        self._capture = settings.capture
+
+    def attach(self, socket_server):
+        """ Sets the game up on `socket_server`: protocol, options, metrics
+            and handlers. Doesn't start anything, replay.py uses it to run
+            the game on a captured session.
+        """
+        self._socket_server = socket_server
         self._socket_server.heartbeat_rate = 35
+        # only what we send is compressed, players never send compressed
+        # messages, so the server's protocol has no compressor
         self._socket_server._message_protocol = PacketProtocol()
+        self._socket_server.coalesce = self._coalesce
+        self._socket_server.fragment = self._fragment
+
+        self.metrics = self._socket_server.metrics
+        self._messages_sent = self.metrics.counter('game_messages_sent', 'Messages sent by the game')
+        self._tick_seconds = self.metrics.histogram('game_tick_seconds', 'Time spent in game_loop')
+        self.metrics.gauge('game_players', 'Players in the game', function=lambda: len(self._clients))
+        self.metrics.gauge('game_bullets', 'Bullets in the game', function=self.bullet_count)
+        self.metrics.gauge('game_reliable_pending', 'Reliable messages waiting for an ack', function=lambda: len(self._reliable))
+        self.metrics.gauge('game_reliable_gave_up', 'Reliable messages dropped after too many resends', function=lambda: self._reliable.gave_up)
+        self.metrics.gauge('game_inbox_depth', 'Commands waiting for the next tick', function=lambda: len(self._inbox))
+        self.metrics.gauge('game_dropped_ticks', 'Ticks skipped because the game loop fell behind', function=lambda: self._scheduler.dropped_ticks)
 
         # set up handlers
         self._socket_server.on('connected', self.client_connected)
@@ -176,8 +391,24 @@ class GameServer:
         self._socket_server.on(PacketId.JOIN, self.player_join)
         self._socket_server.on(PacketId.PLAYER_INPUT, self.player_movement)
         self._socket_server.on(PacketId.ACK, self.received_ack)
+        self._socket_server.on(PacketId.ACK_BITS, self.received_ack_bits)
         self._socket_server.on(PacketId.PLAYER_FIRE, self.player_fire)
         self._socket_server.on(PacketId.HEARTBEAT, self.received_heartbeat)
+        self._socket_server.on(PacketId.SNAPSHOT_ACK, self.received_snapshot_ack)
+        self._socket_server.on(PacketId.COMPRESSION, self.received_compression)
+
+    def start(self):
+        self.attach(EventServer(self._server_address))
+        if self._rate_limit > 0:
+            self._socket_server.limiter = TokenBucketLimiter(self._rate_limit, self._rate_limit * 2)
+        if self._handshake:
+            self._socket_server.handshake = CookieHandshake()
+        if self._buffer_pool:
+            self._socket_server.buffer_pool = BufferPool(size=self._socket_server.max_packet_size)
+        if self._capture:
+            self._socket_server.capture = CaptureWriter(self._capture)
+        if self._metrics_port > 0:
+            serve_metrics(self.metrics, ('127.0.0.1', self._metrics_port))
 
         self._server_thread = threading.Thread(target=self._socket_server.serve_forever)
         self._server_thread.daemon = True
@@ -185,27 +416,29 @@ class GameServer:
 
         print("Serving on {}".format(self._socket_server.socket.getsockname()))
 
-        # for a fixed update tick
-        last_time = time.time()
-        loop_time = 1.0 / self._tick_rate
-        loop_timer = 0
-
-        while True:
-            time_now = time.time()
-            delta = time_now - last_time
-            last_time = time_now            
-
-            loop_timer += delta
-            if loop_timer >= loop_time:
-                if loop_timer >= loop_time * 1.5:
-                    print("----------------------")
-                    print("FRAMERATE DROPPED TO {}fps".format((1.0 / loop_timer)))
-                    print("----------------------")
-
-                self.game_loop(loop_timer)
-                loop_timer = 0
-
-        self._socket_server.shutdown()
+        # fixed update tick
+        self._scheduler.on_overrun = self.tick_overrun
+        try:
+            self._scheduler.run_forever(self.tick)
+        finally:
+            self._socket_server.shutdown()
+            if self._socket_server.capture is not None:
+                self._socket_server.capture.close()
+
+    def tick(self, dt):
+        # everything sent during the tick goes out in one batch
+        self._socket_server.begin_batch()
+        start = time.perf_counter()
+        try:
+            self.game_loop(dt)
+        finally:
+            self._tick_seconds.record(time.perf_counter() - start)
+            self._socket_server.flush()
+
+    def tick_overrun(self, duration):
+        print("----------------------")
+        print("FRAMERATE DROPPED TO {}fps".format((1.0 / duration)))
+        print("----------------------")
 
     def next_player_id(self):
         self._player_id_number += 1
@@ -220,193 +453,392 @@ class GameServer:
             self._sequence_number = 0
         return this_seq
 
-    def send(self, player_id, event, payload, needs_ack=False, seq_num=None):
+    def send(self, player_id, event, payload, needs_ack=False, seq_num=None, broadcast=None, resend=False):
         if player_id not in self._clients:
             return
 
-        if not seq_num:
+        if seq_num is None:
             seq_num = self.next_sequence_number()
 
-        self._stat_sent += 1
+        self._messages_sent.inc()
 
         player = self._clients[player_id]
         player_addr = player.address
                 
-        msg_bytes = self.protocol.create(event, payload, seq_num, needs_ack)
+        if broadcast is not None:
+            msg_bytes = broadcast.for_recipient(seq_num, needs_ack)
+        else:
+            msg_bytes = self.protocol.create(event, payload, seq_num, needs_ack)
 
-        if needs_ack:
-            info = PacketInfo(seq_num, time.time(), player_id, event, payload)
-            # print("new ACK for {} at time: {}".format(seq_num, info.sent_ticks))
-            self._ack_needed.append(info)
+        if player.compress:
+            msg_bytes = self._compressor.compress(msg_bytes)
 
-        self._stat_sent_bandwidth += sys.getsizeof(msg_bytes)
+        if needs_ack and not resend:
+            self._reliable.add(player_id, seq_num, (event, payload), self._socket_server.clock())
 
-        self._socket_server.sendto(player_addr, msg_bytes)
+        self._socket_server.sendto(player_addr, msg_bytes, needs_ack)
 
     def send_all(self, event, payload, needs_ack=False):
-        """Sends the message to all active players."""
+        """Sends the message to all active players.
+            The message is only packed once.
+        """
+        broadcast = self.protocol.create_broadcast(event, payload)
         for player_id, player in self._clients.items():
-            self.send(player_id, event, payload, needs_ack)
+            self.send(player_id, event, payload, needs_ack, broadcast=broadcast)
 
     def game_loop(self, dt):
-        updated_players = []
-
         self._stat_timer -= dt
         if self._stat_timer <= 0:
             self._stat_timer = self._stat_time
-            with lock:
-                sent = self._stat_sent
-                self._stat_sent = 0
-                avg = sent / self._stat_time
-                print("AVG MESSAGES SENT PER SECOND: {}".format(avg))
-                band = self._stat_sent_bandwidth
-                self._stat_sent_bandwidth = 0
-                avg = band / self._stat_time
-                amnt = "bytes"
-                if avg > 1000000:
-                    avg /= 1000
-                    avg /= 1000
-                    amnt = "megabytes"
-                elif avg > 10000:
-                    avg /= 1000
-                    amnt = "kilobytes"
-                print("AVG BANDWIDTH SENT PER SECOND: {} {}".format(avg, amnt))
-                if len(self._clients) > 0:
-                    avg = (sent / self._stat_time) / len(self._clients)
-                    print("AVG MESSAGES PER PLAYER: {}".format(avg))
-
-        with lock:
-            # remove disconnected players
-            for player_id in self._clients_to_remove:
-                if player_id not in self._clients:
-                    continue
-                player = self._clients[player_id]
-
-                # send player_left message to everyone else
-                self.send_all(PacketId.PLAYER_LEFT, self.protocol.pack_data(player.uuid))
-
-                del self._clients[player_id]
-
-            self._clients_to_remove.clear()
-
-            # loop through players and handle updates
+            self.print_stats()
+
+        # everything the network handlers received since the last tick:
+        # joins, leaves, inputs and acks
+        self._inbox.drain()
+
+        # exactly one buffered input per player per tick
+        for player in self._clients.values():
+            movement = player.inputs.next()
+            if movement is not None:
+                player.set_movement(movement)
+
+        # loop through players and handle updates
+        if self._use_entity_store:
+            updated_players = self.update_player_store(dt)
+        else:
+            updated_players = self.update_players(dt)
+
+        if self._delta_snapshots:
+            self.send_snapshots()
+        elif self._interest_radius > 0:
+            for player_id, player in self._clients.items():
+                visible = [updated_players[other] for other in self.visible_players(player) if other in updated_players]
+                if len(visible) > 0:
+                    self.send(player_id, PacketId.PLAYER_UPDATES, self.protocol.pack_data(visible))
+        elif len(updated_players) > 0:
+            # print("sending player updates for {} players".format(len(updated_players)))
+            self.send_all(PacketId.PLAYER_UPDATES, self.protocol.pack_data(list(updated_players.values())))
+
+        # update bullets
+        if self._use_entity_store:
+            dead_bullets, bullet_update = self.update_bullet_store(dt)
+        else:
+            dead_bullets, bullet_update = self.update_bullets(dt)
+
+        # send bullet updates if some were updated or removed
+        if self._interest_radius > 0:
+            for player_id, player in self._clients.items():
+                visible = [bullet_update[bullet] for bullet in self.visible_bullets(player)]
+                if len(visible) > 0 or player.saw_bullets:
+                    self.send(player_id, PacketId.BULLETS, self.protocol.pack_data(visible))
+                player.saw_bullets = len(visible) > 0
+        elif len(bullet_update) > 0 or len(dead_bullets) > 0:
+            self.send_all(PacketId.BULLETS, self.protocol.pack_data(list(bullet_update.values())))
+
+        # resend packets whose ack is overdue
+        for packet in self._reliable.due(self._socket_server.clock()):
+            event, payload = packet.message
+            self.send(packet.client, event, payload, True, packet.sequence, resend=True)
+
+    def print_stats(self):
+        sent = self._messages_sent.value - self._stat_last_sent
+        self._stat_last_sent += sent
+        avg = sent / self._stat_time
+        print("AVG MESSAGES SENT PER SECOND: {}".format(avg))
+        bytes_out = self.metrics.counter('bytes_out').value
+        band = bytes_out - self._stat_last_bytes
+        self._stat_last_bytes = bytes_out
+        avg = band / self._stat_time
+        amnt = "bytes"
+        if avg > 1000000:
+            avg /= 1000
+            avg /= 1000
+            amnt = "megabytes"
+        elif avg > 10000:
+            avg /= 1000
+            amnt = "kilobytes"
+        print("AVG BANDWIDTH SENT PER SECOND: {} {}".format(avg, amnt))
+        if len(self._clients) > 0:
+            avg = (sent / self._stat_time) / len(self._clients)
+            print("AVG MESSAGES PER PLAYER: {}".format(avg))
+
+    def bullet_count(self):
+        if self._use_entity_store:
+            return len(self._bullet_store)
+        return len(self._bullets)
+
+    def update_players(self, dt):
+        """ Moves every player. Returns the as_dict() of every player that
+            moved, by id.
+        """
+        updated_players = {}
+        for player_id, player in self._clients.items():
+            if player.movement[0] != 0 or player.movement[1] != 0:
+                player.position[0] += player.movement[0] * player.speed * dt
+                player.position[1] += player.movement[1] * player.speed * dt                    
+                if player.position[0] <= -self._world.width + 1:
+                    player.position[0] = -self._world.width + 1
+                elif player.position[0] >= self._world.width - 1:
+                    player.position[0] = self._world.width - 1 
+                if player.position[1] < -self._world.height + 1:
+                    player.position[1] = -self._world.height + 1
+                elif player.position[1] >= self._world.height - 1:
+                    player.position[1] = self._world.height - 1
+                self._player_grid.move(player_id, player.position[0], player.position[1])
+                updated_players[player_id] = player.as_dict()
+        return updated_players
+
+    def update_bullets(self, dt):
+        """ Moves and expires every bullet. Returns (dead bullets,
+            as_dict() by bullet).
+        """
+        dead_bullets = []
+        bullet_update = {}
+        for bullet in self._bullets:
+            bullet.lifetime -= dt
+            if bullet.lifetime <= 0:
+                dead_bullets.append(bullet)
+                continue
+            bullet.position[0] += bullet.direction[0] * bullet.speed * dt
+            bullet.position[1] += bullet.direction[1] * bullet.speed * dt
+            self._bullet_grid.move(bullet, bullet.position[0], bullet.position[1])
+            bullet_update[bullet] = bullet.as_dict()
+
+        # remove dead bullets
+        for bullet in dead_bullets:
+            self._bullets.remove(bullet)
+            self._bullet_grid.remove(bullet)
+        return dead_bullets, bullet_update
+
+    def update_player_store(self, dt):
+        """ Moves every player in one vectorized step. Returns the as_dict()
+            of every player that moved, by id.
+        """
+        store = self._player_store
+        for player_id, player in self._clients.items():
+            row = store.row(player_id)
+            store.velocity[row, 0] = player.movement[0] * player.speed
+            store.velocity[row, 1] = player.movement[1] * player.speed
+
+        width = self._world.width - 1
+        height = self._world.height - 1
+        store.integrate(dt, ((-width, -height), (width, height)))
+
+        updated_players = {}
+        n = store.count
+        moving = (store.velocity[:n] != 0).any(axis=1).nonzero()[0]
+        for player_id, (x, y) in zip(store.ids[moving].tolist(), store.position[moving].tolist()):
+            player = self._clients[player_id]
+            player.position[0] = x
+            player.position[1] = y
+            self._player_grid.move(player_id, x, y)
+            updated_players[player_id] = player.as_dict()
+        return updated_players
+
+    def update_bullet_store(self, dt):
+        """ Spawns, moves, expires and hit tests every bullet as batch
+            operations. Bullets that hit a player other than their owner
+            are removed. Returns (dead bullet ids, as_dict() by bullet id).
+        """
+        store = self._bullet_store
+        fired, self._fired = self._fired, []
+        for position, direction, owner in fired:
+            self._bullet_id_number += 1
+            velocity = (direction[0] * Bullet.SPEED, direction[1] * Bullet.SPEED)
+            store.add(self._bullet_id_number, position, velocity, Bullet.LIFETIME, owner)
+
+        dead_bullets = store.expire(dt)
+        store.integrate(dt)
+
+        rows, _ = store.hits(self._player_store, self._hit_radius)
+        if len(rows) > 0:
+            hit = np.zeros(store.count, dtype=bool)
+            hit[rows] = True
+            dead_bullets += store.remove_rows(hit)
+
+        for bullet_id in dead_bullets:
+            self._bullet_grid.remove(bullet_id)
+
+        n = store.count
+        positions = (store.position[:n] * 1000).tolist()
+        rotations = (np.degrees(np.arctan2(store.velocity[:n, 1], store.velocity[:n, 0])) * 1000).tolist()
+        bullet_update = {}
+        for bullet_id, position, rotation in zip(store.ids[:n].tolist(), positions, rotations):
+            if self._interest_radius > 0:
+                self._bullet_grid.move(bullet_id, position[0] / 1000, position[1] / 1000)
+            bullet_update[bullet_id] = {"position": position, "rotation": rotation}
+        return dead_bullets, bullet_update
+
+    def visible_players(self, player):
+        """ Ids of the players within the area of interest of `player`. """
+        return self._player_grid.query(player.position[0], player.position[1], self._interest_radius)
+
+    def visible_bullets(self, player):
+        return self._bullet_grid.query(player.position[0], player.position[1], self._interest_radius)
+
+    def send_snapshots(self):
+        """ Sends every player the changes since the last snapshot they
+            acked. Players who share a baseline get the same bytes.
+        """
+        snapshot = {player_id: player.snapshot() for player_id, player in self._clients.items()}
+        sequence = self._replicator.next_sequence()
+        if self._interest_radius > 0:
+            # every player has their own snapshot, nothing to share
             for player_id, player in self._clients.items():
-                if player.movement[0] != 0 or player.movement[1] != 0:
-                    player.position[0] += player.movement[0] * player.speed * dt
-                    player.position[1] += player.movement[1] * player.speed * dt                    
-                    if player.position[0] <= -self._world.width + 1:
-                        player.position[0] = -self._world.width + 1
-                    elif player.position[0] >= self._world.width - 1:
-                        player.position[0] = self._world.width - 1 
-                    if player.position[1] < -self._world.height + 1:
-                        player.position[1] = -self._world.height + 1
-                    elif player.position[1] >= self._world.height - 1:
-                        player.position[1] = self._world.height - 1
-                    updated_players.append(player.as_dict())
-
-            if len(updated_players) > 0:
-                # print("sending player updates for {} players".format(len(updated_players)))
-                self.send_all(PacketId.PLAYER_UPDATES, self.protocol.pack_data(updated_players))
-
-            # update bullets
-            dead_bullets = []
-            bullet_update = []
-            for bullet in self._bullets:
-                bullet.lifetime -= dt
-                if bullet.lifetime <= 0:
-                    dead_bullets.append(bullet)
-                    continue
-                bullet.position[0] += bullet.direction[0] * bullet.speed * dt
-                bullet.position[1] += bullet.direction[1] * bullet.speed * dt
-                bullet_update.append(bullet.as_dict())
-
-            # remove dead bullets
-            for bullet in dead_bullets:
-                self._bullets.remove(bullet)
-
-            # send bullet updates if some were updated or removed
-            if len(bullet_update) > 0 or len(dead_bullets) > 0:
-                self.send_all(PacketId.BULLETS, self.protocol.pack_data(bullet_update))
-
-            # loop through the Acks queue to see if we need to send more acks
-            if len(self._ack_needed):
-                resend_acks = []
-                while len(self._ack_needed) > 0:
-                    ack = self._ack_needed[0]
-                    since = time.time() - ack.sent_ticks
-                    if since >= 2:
-                        # resend and requeue
-                        # print("ACK needed for {}".format(ack.sequence_number))
-                        resend_acks.append(self._ack_needed.pop())
-                    else:
-                        # hit a young pack, quit for now
-                        # oldest packs will be at the front
-                        break
-
-                for ack in resend_acks:
-                    self.send(ack.target, ack.event, ack.payload, True, ack.sequence_number)
-    
+                visible = {other: snapshot[other] for other in self.visible_players(player)}
+                message = self._replicator.encode(player_id, sequence, visible)
+                self.send(player_id, PacketId.SNAPSHOT, self.protocol.pack_data(message))
+            return
+
+        packed = {}
+        for player_id in self._clients:
+            baseline = self._replicator.baseline(player_id, sequence)
+            baseline_sequence = baseline[0] if baseline else -1
+            if baseline_sequence not in packed:
+                packed[baseline_sequence] = self.protocol.pack_data(self._replicator.delta(baseline, sequence, snapshot))
+            self._replicator.remember(player_id, sequence, snapshot)
+            self.send(player_id, PacketId.SNAPSHOT, packed[baseline_sequence])
+
     def sequence_more_recent(self, s1, s2):
-        return (s1 > s2 and s1 - s2 <= self._max_sequence_number / 2) or (s2 > s1 and s2 - s1 > self._max_sequence_number/2)
+        return sequence_more_recent(s1, s2, self._max_sequence_number)
 
     def player_join(self, msg, socket):
         pass
 
+    # Network handlers. These run on the server's threads, so they only
+    # decode the packet and queue a command for the tick thread.
+
     def client_connected(self, msg, socket):
         """ Both 'connected' and 'disconnected' are events
             reserved by the server. It will call them automatically.
         """
-        with lock:            
-            player = PlayerClient(self.next_player_id(), socket)
-            print("New client: {} is now player {}".format(socket, player.uuid))
-            self._clients[player.uuid] = player
-            self._socket_to_player[socket] = player.uuid
-
-            # send welcome
-            # print(player.as_dict())
-            self.send(player.uuid, PacketId.WELCOME, self.protocol.pack_data(player.as_dict()), True)
-
-            # send world, require acknowledge
-            self.send(player.uuid, PacketId.WORLD_INFO, self.protocol.pack_data(self._world.as_dict()), True)
-    
+        self._inbox.put(self.add_player, socket)
+
     def client_disconnected(self, msg, socket):
-        player = self._clients[self._socket_to_player[socket]]
-        print("Player {} has disconnected.".format(player.uuid))
-        if player.uuid in self._clients and player.uuid not in self._clients_to_remove:
-            self._clients_to_remove.append(player.uuid)
+        self._inbox.put(self.remove_player, socket)
 
     def player_movement(self, msg, socket):
-        if socket not in self._socket_to_player:
-            return        
+        self._inbox.put(self.move_player, socket, self.protocol.unpack_data(msg))
+
+    def player_fire(self, msg, socket):
+        self._inbox.put(self.fire_bullet, socket)
+
+    def received_heartbeat(self, msg, socket):
+        pass
+
+    def received_snapshot_ack(self, msg, socket):
+        self._inbox.put(self.ack_snapshot, socket, self.protocol.unpack_data(msg))
+
+    def received_ack(self, msg, socket):
+        self._inbox.put(self.ack_packets, socket, self.protocol.unpack_data(msg))
+
+    def received_ack_bits(self, msg, socket):
+        """ [last sequence received, bitfield of the 32 before it] """
+        self._inbox.put(self.ack_packet_bits, socket, self.protocol.unpack_data(msg))
+
+    def received_compression(self, msg, socket):
+        """ [method, dictionary id] the client can decompress with. """
+        self._inbox.put(self.negotiate_compression, socket, self.protocol.unpack_data(msg))
 
-        player = self._clients[self._socket_to_player[socket]]
-        movement = self.protocol.unpack_data(msg)
-        # print("Got player input for {}: {}".format(player.uuid, movement))
+    # Commands. These run on the tick thread, from the inbox.
+
+    def add_player(self, socket):
+        if socket in self._socket_to_player:
+            return
+        player = PlayerClient(self.next_player_id(), socket, self._input_delay)
+        print("New client: {} is now player {}".format(socket, player.uuid))
+        self._clients[player.uuid] = player
+        self._socket_to_player[socket] = player.uuid
+        self._replicator.add_client(player.uuid)
+        self._player_grid.move(player.uuid, player.position[0], player.position[1])
+        if self._use_entity_store:
+            self._player_store.add(player.uuid, player.position)
+
+        # send welcome
+        # print(player.as_dict())
+        self.send(player.uuid, PacketId.WELCOME, self.protocol.pack_data(player.as_dict()), True)
+
+        # send world, require acknowledge
+        self.send(player.uuid, PacketId.WORLD_INFO, self.protocol.pack_data(self._world.as_dict()), True)
+
+    def remove_player(self, socket):
+        player_id = self._socket_to_player.pop(socket, None)
+        if player_id is None:
+            return
+        print("Player {} has disconnected.".format(player_id))
+        del self._clients[player_id]
+        self._reliable.forget(player_id)
+        self._replicator.remove_client(player_id)
+        self._player_grid.remove(player_id)
+        if self._use_entity_store:
+            self._player_store.remove(player_id)
+
+        # send player_left message to everyone else
+        self.send_all(PacketId.PLAYER_LEFT, self.protocol.pack_data(player_id))
+
+    def move_player(self, socket, movement):
+        """ PLAYER_INPUT is either [x, y], applied right away, or a list of
+            stamped inputs [[sequence, client tick, x, y], ...] for the
+            player's input buffer.
+        """
+        player_id = self._socket_to_player.get(socket)
+        if player_id is None:
+            return
+        player = self._clients[player_id]
+        # print("Got player input for {}: {}".format(player_id, movement))
+        if movement and isinstance(movement[0], (list, tuple)):
+            for sequence, tick, x, y in movement:
+                player.inputs.add(sequence, tick, [x, y])
+            return
         player.set_movement(movement)
 
-    def player_fire(self, msg, socket):
-        if socket not in self._socket_to_player:
+    def fire_bullet(self, socket):
+        player_id = self._socket_to_player.get(socket)
+        if player_id is None:
             return
+        player = self._clients[player_id]
 
-        player = self._clients[self._socket_to_player[socket]]
-        
         # create bullet
-        bullet = Bullet(player.position, player.facing, player.uuid)
+        if self._use_entity_store:
+            # spawned by update_bullet_store()
+            self._fired.append((list(player.position), list(player.facing), player.uuid))
+            return
+        bullet = Bullet(list(player.position), player.facing, player.uuid)
         self._bullets.append(bullet)
 
-    def received_heartbeat(self, msg, socket):
-        pass
+    def negotiate_compression(self, socket, offer):
+        """ Compresses everything sent to the player from now on if they
+            have the same dictionary we do. Answers with what was agreed
+            on, or None.
+        """
+        player_id = self._socket_to_player.get(socket)
+        if player_id is None:
+            return
+        player = self._clients[player_id]
+        compressor = self._compressor
+        player.compress = compressor is not None and list(offer) == [compressor.method, compressor.dictionary_id]
+        answer = offer if player.compress else None
+        self.send(player_id, PacketId.COMPRESSION, self.protocol.pack_data(answer))
+
+    def ack_snapshot(self, socket, sequence):
+        player_id = self._socket_to_player.get(socket)
+        if player_id is not None:
+            self._replicator.ack(player_id, sequence)
+
+    def ack_packets(self, socket, acks):
+        player_id = self._socket_to_player.get(socket)
+        if player_id is None:
+            return
+        now = self._socket_server.clock()
+        for ack in acks:
+            self._reliable.ack(player_id, ack, now)
 
-    def received_ack(self, msg, socket):
-        if socket not in self._socket_to_player:
+    def ack_packet_bits(self, socket, ack_bits):
+        player_id = self._socket_to_player.get(socket)
+        if player_id is None:
             return
-        acks = self.protocol.unpack_data(msg)
-        with lock:
-            for ack in acks:
-                ackInfo = next((a for a in self._ack_needed if a.sequence_number == ack), None)
-                if ackInfo and ackInfo:
-                    # print("ack received: {}".format(ackInfo.sequence_number))
-                    self._ack_needed.remove(ackInfo)                
+        last_sequence, bits = ack_bits
+        self._reliable.ack_bits(player_id, last_sequence, bits, self._socket_server.clock())
 
 ARGS = argparse.ArgumentParser(description="Example Game Server")
 
@@ -433,6 +865,103 @@ ARGS.add_argument(
     help="Tick rate of the game loop in frames per second."
 )
 
+ARGS.add_argument(
+    '--deltaSnapshots',
+    action="store_true",
+    dest="deltaSnapshots",
+    help="Replicate players with delta-compressed SNAPSHOT messages instead of PLAYER_UPDATES."
+)
+
+ARGS.add_argument(
+    '--interestRadius',
+    action="store",
+    dest="interestRadius",
+    default="0",
+    help="Only send players updates about things within this many units of them. 0 sends everything."
+)
+
+ARGS.add_argument(
+    '--entityStore',
+    action="store_true",
+    dest="entityStore",
+    help="Simulate players and bullets with NumPy arrays (needs numpy)."
+)
+
+ARGS.add_argument(
+    '--coalesce',
+    action="store_true",
+    dest="coalesce",
+    help="Pack all messages sent to a player in one tick into as few datagrams as possible."
+)
+
+ARGS.add_argument(
+    '--fragment',
+    action="store_true",
+    dest="fragment",
+    help="Split messages bigger than 1200 bytes into fragments. Reliable ones only resend lost fragments."
+)
+
+ARGS.add_argument(
+    '--compress',
+    action="store_true",
+    dest="compress",
+    help="Compress messages to players that ask for it (fake_client.py --compress)."
+)
+
+ARGS.add_argument(
+    '--compressDictionary',
+    action="store",
+    dest="compressDictionary",
+    default="",
+    help="Preset dictionary for --compress, made with benchmark_compression.py --train."
+)
+
+ARGS.add_argument(
+    '--inputDelay',
+    action="store",
+    dest="inputDelay",
+    default="2",
+    help="Ticks of stamped player input to buffer, to smooth out jitter."
+)
+
+ARGS.add_argument(
+    '--metricsPort',
+    action="store",
+    dest="metricsPort",
+    default="0",
+    help="Serve Prometheus metrics at http://127.0.0.1:<port>/metrics. 0 turns it off."
+)
+
+ARGS.add_argument(
+    '--rateLimit',
+    action="store",
+    dest="rateLimit",
+    default="0",
+    help="Drop datagrams from an address sending more than this many a second. 0 turns it off."
+)
+
+ARGS.add_argument(
+    '--handshake',
+    action="store_true",
+    dest="handshake",
+    help="Only accept clients that completed the cookie handshake (fake_client.py --handshake)."
+)
+
+ARGS.add_argument(
+    '--bufferPool',
+    action="store_true",
+    dest="bufferPool",
+    help="Receive datagrams into a pool of preallocated buffers with recvfrom_into."
+)
+
+ARGS.add_argument(
+    '--capture',
+    action="store",
+    dest="capture",
+    default="",
+    help="Record every datagram to <capture>.0000, .0001, ... for replay.py."
+)
+
 if __name__ == "__main__":
     args = ARGS.parse_args()
 
@@ -11,7 +11,11 @@ import time
 import json
 import argparse
 # from message import MessageProtocol
-from example_game_server import PacketProtocol, PacketId
+from example_game_server import PacketProtocol, PacketId, PlayerClient, MAX_SEQUENCE_NUMBER
+from replication import SnapshotReceiver
+from server import ReceivedSequences, split_datagram, client_handshake, handshake_reply, HANDSHAKE
+from server import Reassembler, FRAGMENT
+from message import Compressor
 import random
 import threading
 import msgpack
@@ -48,8 +52,38 @@ ARGS.add_argument(
     help="Server port to connect to."
 )
 
+ARGS.add_argument(
+    '--compress',
+    action="store_true",
+    dest="compress",
+    help="Ask the server to compress what it sends us."
+)
+
+ARGS.add_argument(
+    '--compressDictionary',
+    action="store",
+    dest="compressDictionary",
+    default="",
+    help="Preset dictionary for --compress. Must be the one the server uses."
+)
 
-def client(mv_speed, host_port):
+ARGS.add_argument(
+    '--inputRate',
+    action="store",
+    dest="inputRate",
+    default="60",
+    help="Stamped inputs sent per second, one per server tick (the server's --tickRate). 0 sends plain [x, y] input only when it changes."
+)
+
+ARGS.add_argument(
+    '--handshake',
+    action="store_true",
+    dest="handshake",
+    help="Do the cookie handshake first, for servers run with --handshake."
+)
+
+
+def client(mv_speed, host_port, handshake=False, compressor=None, input_rate=60):
 
     # SOCK_DGRAM is the socket type to use for UDP sockets
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -59,6 +93,7 @@ def client(mv_speed, host_port):
 
     # message_protocol = MessageProtocol()
     message_protocol = PacketProtocol()
+    message_protocol.compressor = compressor
 
     time_last = time.time()
     movement_timer = 0
@@ -66,12 +101,30 @@ def client(mv_speed, host_port):
 
     movement = [0, 0]
 
+    # every input is stamped and sent a few times, in case some are lost
+    input_timer = 0
+    input_sequence = 0
+    input_tick = 0
+    recent_inputs = []
+
     welcomed = False
 
     my_player = None
 
+    snapshots = SnapshotReceiver(PlayerClient.SNAPSHOT_FIELDS)
+
+    # sequence numbers of reliable packets we got, acked as a bitfield
+    received = ReceivedSequences(MAX_SEQUENCE_NUMBER + 1)
+
+    # puts messages the server fragmented back together
+    reassembler = Reassembler()
+
     try:
 
+        if handshake and not client_handshake(sock, host_port):
+            print("Handshake with {} failed.".format(host_port))
+            return
+
         # send first message to the server to tell it we want to join.
         data = message_protocol.create(PacketId.JOIN, "hello, world", 0)
         sock.sendto(data, host_port)
@@ -87,29 +140,65 @@ def client(mv_speed, host_port):
                 if movement_timer < 0:
                     movement[0] = random.randrange(-1, 2)
                     movement[1] = random.randrange(-1, 2)
-                    data = message_protocol.create(PacketId.PLAYER_INPUT, message_protocol.pack_data(movement), 0)
-                    sock.sendto(data, host_port)
+                    if input_rate <= 0:
+                        data = message_protocol.create(PacketId.PLAYER_INPUT, message_protocol.pack_data(movement), 0)
+                        sock.sendto(data, host_port)
                     movement_timer = movement_time
 
+                if input_rate > 0:
+                    input_timer -= delta
+                    if input_timer < 0:
+                        input_timer = 1.0 / input_rate
+                        input_sequence = (input_sequence + 1) % (MAX_SEQUENCE_NUMBER + 1)
+                        input_tick += 1
+                        recent_inputs.append([input_sequence, input_tick, movement[0], movement[1]])
+                        del recent_inputs[:-3]
+                        data = message_protocol.create(PacketId.PLAYER_INPUT, message_protocol.pack_data(recent_inputs), 0)
+                        sock.sendto(data, host_port)
+
             try:
                 message, address = sock.recvfrom(8192)
-                if message:
-                    parsed = message_protocol.parse(message)
-                    message_type = parsed[0]
-                    # print("Got message: {}".format(parsed))
-                    payload = parsed[3]
-                    needs_ack = True if parsed[2] == 1 else False
-                    sequence_number = parsed[1]
-
-                    if message_type == PacketId.WELCOME:
-                        welcomed = True
-                        my_player = message_protocol.unpack_data(payload)
-                        print("me: {}".format(my_player))
-
-                    if needs_ack:
-                        # send Ack
-                        data = message_protocol.create(PacketId.ACK, message_protocol.pack_data([sequence_number]), 0)
-                        sock.sendto(data, host_port)
+                if message and message[0] == HANDSHAKE:
+                    # the server forgot us and wants the handshake again
+                    reply = handshake_reply(message)
+                    if reply:
+                        sock.sendto(reply, host_port)
+                    continue
+                for message in split_datagram(message):
+                    if message and message[0] == FRAGMENT:
+                        message, ack = reassembler.add(address, message, time.monotonic())
+                        if ack:
+                            sock.sendto(ack, host_port)
+                    if message:
+                        parsed = message_protocol.parse(message)
+                        message_type = parsed[0]
+                        # print("Got message: {}".format(parsed))
+                        payload = parsed[3]
+                        needs_ack = True if parsed[2] == 1 else False
+                        sequence_number = parsed[1]
+
+                        if message_type == PacketId.WELCOME:
+                            welcomed = True
+                            my_player = message_protocol.unpack_data(payload)
+                            print("me: {}".format(my_player))
+
+                            if compressor is not None:
+                                # now that the server knows us, ask it to compress
+                                offer = [compressor.method, compressor.dictionary_id]
+                                data = message_protocol.create(PacketId.COMPRESSION, message_protocol.pack_data(offer), 0)
+                                sock.sendto(data, host_port)
+
+                        if message_type == PacketId.SNAPSHOT:
+                            snapshot = snapshots.apply(message_protocol.unpack_data(payload))
+                            if snapshot:
+                                data = message_protocol.create(PacketId.SNAPSHOT_ACK, message_protocol.pack_data(snapshot[0]), 0)
+                                sock.sendto(data, host_port)
+
+                        if needs_ack:
+                            # send Ack
+                            received.received(sequence_number)
+                            data = message_protocol.create(PacketId.ACK_BITS, message_protocol.pack_data(received.ack_payload()), 0)
+                            sock.sendto(data, host_port)
             except OSError as err:
                 # print("we have a problem: {}".format(err))
                 pass
@@ -128,10 +217,17 @@ if __name__ == '__main__':
     num_clients = int(args.count)
     print("Spawning {} clients.".format(num_clients))
     movement_speed = float(args.speed)
+    compressor = None
+    if args.compress:
+        dictionary = b''
+        if args.compressDictionary:
+            with open(args.compressDictionary, 'rb') as f:
+                dictionary = f.read()
+        compressor = Compressor(dictionary)
     client_threads = []
     for i in range(0, num_clients):
         print("starting client {}".format(i))
-        client_thread = threading.Thread(target=client, args=[movement_speed, host_port])
+        client_thread = threading.Thread(target=client, args=[movement_speed, host_port, args.handshake, compressor, float(args.inputRate)])
         client_thread.daemon = True
         client_thread.start()
         client_threads.append(client_thread)
@@ -0,0 +1,338 @@
+# loadtest.py
+#
+# Load generator and benchmark harness. A single asyncio process simulates
+# thousands of clients (one UDP socket each) against a server running in its
+# own process, and reports packets/sec, round trip latency, loss and server
+# CPU. Results can be saved as a baseline and later runs compared to it.
+#
+# Scenarios:
+#   echo   - every client sends `--rate` pings a second, the server answers
+#   join   - every client joins at the same time, the server welcomes them
+#   fanout - every client joins, then the server broadcasts a tick to all
+#            of them `--tickRate` times a second
+#
+# Example:
+#   python loadtest.py echo --clients 1000 --backend async --save baseline.json
+#   python loadtest.py echo --clients 1000 --backend async --compare baseline.json
+#
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from message import MessageProtocol
+import server as servers
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BACKENDS = {
+    "threaded": servers.EventServer,
+    "async": servers.AsyncEventServer,
+    "batched": servers.BatchedEventServer,
+    "pooled": servers.PooledEventServer,
+}
+
+ARGS = argparse.ArgumentParser(description="UDP load test")
+ARGS.add_argument('scenario', choices=["echo", "join", "fanout"], help="What to measure.")
+ARGS.add_argument('--clients', action="store", dest="clients", default="500", help="How many clients to simulate.")
+ARGS.add_argument('--duration', action="store", dest="duration", default="5", help="How long to run, in seconds.")
+ARGS.add_argument('--rate', action="store", dest="rate", default="10", help="echo: pings per second per client.")
+ARGS.add_argument('--tickRate', action="store", dest="tickRate", default="30", help="fanout: broadcasts per second.")
+ARGS.add_argument('--backend', action="store", dest="backend", default="threaded", choices=sorted(BACKENDS), help="Server class to test.")
+ARGS.add_argument('--bufferPool', action="store_true", dest="bufferPool", help="Receive into pooled buffers (not the async backend).")
+ARGS.add_argument('--host', action="store", dest="host", default="127.0.0.1", help="Address to run the server on.")
+ARGS.add_argument('--port', action="store", dest="port", default="9990", help="Port to run the server on.")
+ARGS.add_argument('--seed', action="store", dest="seed", default="1", help="Seed for the send jitter.")
+ARGS.add_argument('--save', action="store", dest="save", default=None, help="Save the results as a baseline to this file.")
+ARGS.add_argument('--compare', action="store", dest="compare", default=None, help="Compare the results to the baseline in this file.")
+ARGS.add_argument('--tolerance', action="store", dest="tolerance", default="0.15", help="How much worse than the baseline is still OK (0.15 = 15%%).")
+
+# for each result: True if higher is better
+RESULT_DIRECTIONS = {
+    "packets_per_sec": True,
+    "joins_per_sec": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "loss": False,
+    "server_cpu": False,
+}
+
+
+def run_server(scenario, backend, address, tick_rate, buffer_pool, ready, stop, results):
+    """ Server process. """
+    server = BACKENDS[backend](address)
+    if buffer_pool:
+        server.buffer_pool = servers.BufferPool()
+    server.debug_message_unhandled = False
+    server.heartbeat_rate = 0
+
+    server.on('connected', lambda msg, client: server.send(client, 'welcome', None))
+    server.on('ping', lambda msg, client: server.send(client, 'pong', msg))
+
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    scheduler = None
+    if scenario == "fanout":
+        sequence = [0]
+
+        def broadcast(dt):
+            sequence[0] += 1
+            server.begin_batch()
+            server.send_all('tick', [sequence[0], time.monotonic()])
+            server.flush()
+
+        scheduler = servers.TickScheduler(tick_rate)
+        tick_thread = threading.Thread(target=scheduler.run_forever, args=[broadcast])
+        tick_thread.daemon = True
+        tick_thread.start()
+
+    ready.set()
+    start_cpu = time.process_time()
+    stop.wait()
+    cpu = time.process_time() - start_cpu
+
+    if scheduler is not None:
+        scheduler.stop()
+    server.shutdown()
+    server.server_close()
+    results.put({"cpu_seconds": cpu, "metrics": server.metrics.snapshot()})
+
+
+class LoadClient(asyncio.DatagramProtocol):
+    """ One simulated client. """
+    def __init__(self, test):
+        self.test = test
+        self.transport = None
+        self.joined_at = None
+        self.join_sent_at = None
+        self.first_tick = None
+        self.last_tick = None
+        self.ticks = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.test.received(self, self.test.protocol.parse(data))
+
+    def error_received(self, exc):
+        pass
+
+    def send(self, event, payload):
+        self.transport.sendto(self.test.protocol.create(event, payload))
+        self.test.sent += 1
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.address = (args.host, int(args.port))
+        self.protocol = MessageProtocol()
+        self.random = random.Random(int(args.seed))
+        self.clients = []
+        self.sent = 0
+        self.replies = 0
+        self.latencies = []
+        # only count fanout ticks once everyone has joined
+        self.measuring = False
+
+    def received(self, client, message):
+        event, payload = message[0], message[3]
+        now = time.monotonic()
+        if event == 'welcome':
+            if client.joined_at is None:
+                client.joined_at = now
+        elif event == 'pong':
+            self.replies += 1
+            self.latencies.append(now - payload[1])
+        elif event == 'tick' and self.measuring:
+            sequence, sent_at = payload
+            if client.first_tick is None:
+                client.first_tick = sequence
+            client.last_tick = sequence
+            client.ticks += 1
+            self.latencies.append(now - sent_at)
+
+    async def open_clients(self):
+        loop = asyncio.get_running_loop()
+        for _ in range(int(self.args.clients)):
+            _, client = await loop.create_datagram_endpoint(
+                lambda: LoadClient(self), remote_addr=self.address)
+            self.clients.append(client)
+
+    async def join(self, timeout=5.0):
+        for client in self.clients:
+            client.join_sent_at = time.monotonic()
+            client.send('join', None)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(c.joined_at is None for c in self.clients):
+            await asyncio.sleep(0.01)
+
+    async def echo(self, duration):
+        rate = float(self.args.rate)
+        # spread the clients over the interval in small groups, instead of
+        # everyone sending at once and overflowing the socket buffers
+        groups = [self.clients[i:i + 50] for i in range(0, len(self.clients), 50)]
+        interval = 1.0 / rate / len(groups)
+        start = time.monotonic()
+        next_send = start
+        sequence = 0
+        while time.monotonic() - start < duration:
+            for group in groups:
+                for client in group:
+                    sequence += 1
+                    client.send('ping', [sequence, time.monotonic()])
+                # a little jitter so clients don't all line up with the server
+                next_send += interval * self.random.uniform(0.9, 1.1)
+                await asyncio.sleep(max(0, next_send - time.monotonic()))
+        sent = self.sent
+        # let outstanding replies arrive
+        await asyncio.sleep(1.0)
+        return {
+            "packets_per_sec": self.replies / duration,
+            "loss": 1 - self.replies / sent if sent else 0,
+        }
+
+    async def run(self):
+        args = self.args
+        duration = float(args.duration)
+        await self.open_clients()
+
+        if args.scenario == "echo":
+            results = await self.echo(duration)
+        elif args.scenario == "join":
+            start = time.monotonic()
+            await self.join()
+            joined = [c for c in self.clients if c.joined_at is not None]
+            last = max((c.joined_at for c in joined), default=start)
+            self.latencies = [c.joined_at - c.join_sent_at for c in joined]
+            results = {
+                "joins_per_sec": len(joined) / max(last - start, 1e-9),
+                "loss": 1 - len(joined) / len(self.clients),
+            }
+        else:
+            await self.join()
+            self.measuring = True
+            await asyncio.sleep(duration)
+            self.measuring = False
+            expected = sum(c.last_tick - c.first_tick + 1 for c in self.clients if c.first_tick is not None)
+            got = sum(c.ticks for c in self.clients)
+            results = {
+                "packets_per_sec": got / duration,
+                "loss": 1 - got / expected if expected else 1,
+            }
+
+        for client in self.clients:
+            client.transport.close()
+
+        results["p50_ms"] = percentile(self.latencies, 0.5) * 1000
+        results["p99_ms"] = percentile(self.latencies, 0.99) * 1000
+        return results
+
+
+def percentile(values, quantile):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(quantile * len(values))) - 1)]
+
+
+def raise_file_limit():
+    """ Every client is a socket, so we need lots of file descriptors. """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def baseline_key(args):
+    return "{}/{}/{}".format(args.scenario, args.backend, args.clients)
+
+
+def compare(results, baseline, tolerance):
+    """ Returns a list of descriptions of results worse than the baseline. """
+    regressions = []
+    for name, higher_is_better in RESULT_DIRECTIONS.items():
+        if name not in results or name not in baseline:
+            continue
+        now, then = results[name], baseline[name]
+        if name == "loss":
+            # absolute, loss is usually ~0
+            worse = now - then > 0.01
+        elif higher_is_better:
+            worse = now < then * (1 - tolerance)
+        else:
+            worse = now > then * (1 + tolerance) and now - then > 0.05
+        if worse:
+            regressions.append("{}: {:.4g} (baseline {:.4g})".format(name, now, then))
+    return regressions
+
+
+def main():
+    args = ARGS.parse_args()
+    raise_file_limit()
+
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    server_results = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=run_server,
+        args=[args.scenario, args.backend, (args.host, int(args.port)), int(args.tickRate), args.bufferPool, ready, stop, server_results])
+    server_process.start()
+    ready.wait()
+
+    wall_start = time.monotonic()
+    results = asyncio.run(LoadTest(args).run())
+    wall = time.monotonic() - wall_start
+
+    stop.set()
+    server_info = server_results.get()
+    server_process.join()
+    results["server_cpu"] = server_info["cpu_seconds"] / wall
+
+    print("{} ({} clients, {} backend)".format(args.scenario, args.clients, args.backend))
+    for name, value in sorted(results.items()):
+        print("  {:>16}: {:.4g}".format(name, value))
+
+    status = 0
+    key = baseline_key(args)
+    if args.compare:
+        with open(args.compare) as f:
+            baselines = json.load(f)
+        if key not in baselines:
+            print("No baseline for {} in {}".format(key, args.compare))
+        else:
+            regressions = compare(results, baselines[key], float(args.tolerance))
+            for regression in regressions:
+                print("REGRESSION {}".format(regression))
+            if regressions:
+                status = 1
+            else:
+                print("No regressions against {}".format(args.compare))
+
+    if args.save:
+        baselines = {}
+        if os.path.exists(args.save):
+            with open(args.save) as f:
+                baselines = json.load(f)
+        baselines[key] = results
+        with open(args.save, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print("Saved baseline {} to {}".format(key, args.save))
+
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# Loopback network
+#
+# An in-memory stand-in for UDP, to run a server and thousands of clients in
+# one process without sockets: for benchmarks, and for tests that have to
+# come out the same every run.
+#
+# Time is virtual. Nothing moves until advance() is called, which moves the
+# network's clock forward and delivers every datagram due by then, in order
+# of arrival. Latency, jitter, loss, reordering and duplication all come
+# from one seeded random number generator, so the same seed and the same
+# traffic always give the same deliveries.
+#
+# A server runs on it with `transport=network.socket(address)` and
+# `server.clock = network.clock` (see simulate.py).
+#
+import collections
+import heapq
+import itertools
+import random
+
+
+class LoopbackNetwork:
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, duplicate=0.0, reorder=0.0, reorder_delay=0.01, seed=0):
+        # every datagram takes `latency` plus up to `jitter` seconds
+        self.latency = latency
+        self.jitter = jitter
+        # chance of a datagram being lost, delivered twice, or held back
+        # `reorder_delay` seconds so later ones overtake it
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+
+        self.now = 0.0
+        self.random = random.Random(seed)
+
+        self.sent = 0
+        self.delivered = 0
+        self.lost = 0
+        self.duplicated = 0
+        self.reordered = 0
+        # sent to an address nobody is bound to
+        self.unreachable = 0
+
+        # address -> LoopbackSocket
+        self._sockets = {}
+        # (arrival time, order sent, destination, source, data)
+        self._in_flight = []
+        self._order = itertools.count()
+        self._next_host = itertools.count(1)
+
+    def __len__(self):
+        """ Datagrams in flight. """
+        return len(self._in_flight)
+
+    def clock(self):
+        """ The network's time, for `server.clock`. """
+        return self.now
+
+    def socket(self, address=None):
+        """ A socket bound to `address`, or to a new address of its own. """
+        if address is None:
+            host = next(self._next_host)
+            address = ("10.{}.{}.{}".format(host >> 16 & 255, host >> 8 & 255, host & 255), 9000)
+        if address in self._sockets:
+            raise OSError("{} is already in use".format(address))
+        sock = LoopbackSocket(self, address)
+        self._sockets[address] = sock
+        return sock
+
+    def _send(self, source, destination, data):
+        self.sent += 1
+        rng = self.random
+        if self.loss and rng.random() < self.loss:
+            self.lost += 1
+            return
+        # sockets don't keep a reference to what was sent
+        data = bytes(data)
+        copies = 1
+        if self.duplicate and rng.random() < self.duplicate:
+            self.duplicated += 1
+            copies = 2
+        for _ in range(copies):
+            delay = self.latency
+            if self.jitter:
+                delay += rng.uniform(0, self.jitter)
+            if self.reorder and rng.random() < self.reorder:
+                self.reordered += 1
+                delay += self.reorder_delay
+            heapq.heappush(self._in_flight, (self.now + delay, next(self._order), destination, source, data))
+
+    def advance(self, dt=0.0):
+        """ Moves the clock `dt` seconds forward and delivers everything
+            that arrived by then. Returns how many datagrams were delivered.
+        """
+        self.now += dt
+        in_flight = self._in_flight
+        sockets = self._sockets
+        delivered = 0
+        while in_flight and in_flight[0][0] <= self.now:
+            _, _, destination, source, data = heapq.heappop(in_flight)
+            sock = sockets.get(destination)
+            if sock is None:
+                self.unreachable += 1
+                continue
+            sock._queue.append((data, source))
+            delivered += 1
+        self.delivered += delivered
+        return delivered
+
+
+class LoopbackSocket:
+    """ One endpoint on a LoopbackNetwork. Behaves like a non-blocking UDP
+        socket: recvfrom() raises BlockingIOError when nothing is waiting.
+    """
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+        self._queue = collections.deque()
+
+    def __len__(self):
+        """ Datagrams waiting to be read. """
+        return len(self._queue)
+
+    def sendto(self, data, address):
+        self.network._send(self.address, address, data)
+        return len(data)
+
+    def recvfrom(self, bufsize):
+        if not self._queue:
+            raise BlockingIOError()
+        data, address = self._queue.popleft()
+        return data[:bufsize], address
+
+    def recvfrom_into(self, buffer, nbytes=0):
+        if not self._queue:
+            raise BlockingIOError()
+        data, address = self._queue.popleft()
+        nbytes = min(len(data), nbytes or len(buffer))
+        buffer[:nbytes] = data[:nbytes]
+        return nbytes, address
+
+    def getsockname(self):
+        return self.address
+
+    def setblocking(self, flag):
+        pass
+
+    def fileno(self):
+        return -1
+
+    def close(self):
+        if self.network._sockets.get(self.address) is self:
+            del self.network._sockets[self.address]
+        self._queue.clear()
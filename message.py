@@ -1,15 +1,251 @@
+import collections
 import json
+import struct
+import threading
+import zlib
+from collections import namedtuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 class MessageProtocol:
+    """ JSON protocol. Every message is {"t": <type>, "p": <payload>}.
+
+        parse() returns the same shape as every other protocol:
+        [type, sequence number, needs ack, payload]
+    """
 
     def create(self, msg_type, payload):
         msg = {
             "t": msg_type,
-            "p": json.dumps(payload)
+            "p": payload
         }
-        msg_json = "{}\n".format(json.dumps(msg))
-        return bytes(msg_json, "utf-8")
+        return bytes(json.dumps(msg), "utf-8")
+
+    def create_broadcast(self, msg_type, payload):
+        # nothing differs between recipients
+        return BroadcastMessage(self.create(msg_type, payload), None, None, None)
 
     def parse(self, message):
-        parsed = json.loads(message.decode("utf-8").strip())
-        return parsed["t"], parsed["p"]
\ No newline at end of file
+        # str() decodes bytes and memoryviews alike, without copying first
+        parsed = json.loads(str(message, "utf-8"))
+        return parsed["t"], 0, 0, parsed["p"]
+
+
+class BroadcastMessage:
+    """ A message encoded once for many recipients.
+
+        Only the sequence number and the ack flag differ between
+        recipients. They live at fixed offsets in the template, so every
+        recipient gets a copy with those bytes patched in instead of
+        running the encoder again.
+    """
+    def __init__(self, template, seq_offset, seq_struct, ack_offset, ack_values=(0, 1)):
+        self.template = template
+        self.seq_offset = seq_offset
+        self.seq_struct = seq_struct
+        self.ack_offset = ack_offset
+        self.ack_values = ack_values
+
+    def for_recipient(self, sequence_number=0, needs_ack=False):
+        if self.seq_struct is None and self.ack_offset is None:
+            return self.template
+        buf = bytearray(self.template)
+        if self.seq_struct is not None:
+            self.seq_struct.pack_into(buf, self.seq_offset, sequence_number)
+        if self.ack_offset is not None:
+            buf[self.ack_offset] = self.ack_values[1 if needs_ack else 0]
+        return buf
+
+
+class MessageSchema:
+    """ Fixed binary layout for one message type, compiled once. """
+    def __init__(self, msg_type, type_id, body_format, fields=None):
+        self.msg_type = msg_type
+        self.type_id = type_id
+        # header and body are packed with a single Struct
+        self.packer = struct.Struct(BinaryProtocol.HEADER.format + body_format)
+        self.body = struct.Struct("<" + body_format)
+        self.tuple_class = namedtuple(str(msg_type), fields) if fields else None
+
+
+class BinaryProtocol:
+    """ Binary protocol for message types with a fixed layout.
+
+        Message types are registered once with a struct format for their
+        payload, e.g.
+
+            protocol.register('move', 1, 'ff', ('x', 'y'))
+
+        and are then encoded with a single struct pack. The payload is a
+        sequence of values in field order.
+
+        Every binary message starts with the MAGIC byte. Message types that
+        were never registered are sent with the `fallback` protocol (JSON by
+        default) instead, so they still work, just not as compactly.
+    """
+    MAGIC = 0xB7
+    # magic, type id, sequence number, flags
+    HEADER = struct.Struct("<BHHB")
+    FLAG_ACK = 0x01
+    # the sequence number inside the header, for patching broadcasts
+    SEQUENCE = struct.Struct("<H")
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback if fallback is not None else MessageProtocol()
+        self._by_type = {}
+        self._by_id = {}
+
+    def register(self, msg_type, type_id, body_format, fields=None):
+        if type_id in self._by_id:
+            raise ValueError("type id {} is already registered".format(type_id))
+        schema = MessageSchema(msg_type, type_id, body_format, fields)
+        self._by_type[msg_type] = schema
+        self._by_id[type_id] = schema
+        return schema
+
+    def create(self, msg_type, payload, sequence_number=0, needs_ack=False):
+        schema = self._by_type.get(msg_type)
+        if schema is None:
+            return self.fallback.create(msg_type, payload)
+        flags = self.FLAG_ACK if needs_ack else 0
+        return schema.packer.pack(self.MAGIC, schema.type_id, sequence_number, flags, *payload)
+
+    def create_into(self, buffer, offset, msg_type, payload, sequence_number=0, needs_ack=False):
+        """ Packs a registered message into a preallocated buffer.
+            Returns the number of bytes written.
+        """
+        schema = self._by_type[msg_type]
+        flags = self.FLAG_ACK if needs_ack else 0
+        schema.packer.pack_into(buffer, offset, self.MAGIC, schema.type_id, sequence_number, flags, *payload)
+        return schema.packer.size
+
+    def create_broadcast(self, msg_type, payload):
+        schema = self._by_type.get(msg_type)
+        if schema is None:
+            return self.fallback.create_broadcast(msg_type, payload)
+        template = schema.packer.pack(self.MAGIC, schema.type_id, 0, 0, *payload)
+        return BroadcastMessage(template, 3, self.SEQUENCE, 5, (0, self.FLAG_ACK))
+
+    def parse(self, message):
+        if not message or message[0] != self.MAGIC:
+            return self.fallback.parse(message)
+        _, type_id, sequence_number, flags = self.HEADER.unpack_from(message)
+        schema = self._by_id[type_id]
+        payload = schema.body.unpack_from(message, self.HEADER.size)
+        if schema.tuple_class is not None:
+            payload = schema.tuple_class._make(payload)
+        return schema.msg_type, sequence_number, flags & self.FLAG_ACK, payload
+
+
+class Compressor:
+    """ Compresses whole messages against a preset dictionary.
+
+        Game messages are small and look alike (same keys, similar numbers),
+        so compressing each one on its own gains little. With a dictionary
+        built from real traffic (see train_dictionary()) the compressor
+        starts out already "knowing" them.
+
+        Messages shorter than `threshold`, or that don't get smaller, are
+        left alone. Compressed messages start with MARKER, so decompress()
+        passes everything else through untouched. Both ends must use the
+        same dictionary; `dictionary_id` is what they compare when they
+        negotiate.
+
+        `method` is 'zlib', or 'zstd' if the zstandard package is installed.
+        decompress() refuses anything that would inflate to more than
+        `max_size` bytes.
+    """
+    # on its own 0xC4 is a msgpack bin 8, which no protocol sends as a
+    # whole message
+    MARKER = 0xC4
+
+    def __init__(self, dictionary=b'', threshold=64, level=6, method='zlib', max_size=128 * 1024):
+        if method == 'zstd' and zstandard is None:
+            raise RuntimeError("zstd compression needs zstandard, `pip install zstandard`")
+        self.dictionary = bytes(dictionary)
+        self.threshold = threshold
+        self.level = level
+        self.method = method
+        self.max_size = max_size
+        self.dictionary_id = zlib.crc32(method.encode() + self.dictionary)
+        self._marker = bytes((self.MARKER,))
+        # zstd contexts can't be shared between threads
+        self._local = threading.local()
+
+    def _zstd(self):
+        local = self._local
+        if not hasattr(local, 'compressor'):
+            dictionary = zstandard.ZstdCompressionDict(self.dictionary) if self.dictionary else None
+            local.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=dictionary)
+            local.decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+        return local
+
+    def compress(self, data):
+        if len(data) < self.threshold:
+            return data
+        if self.method == 'zstd':
+            packed = self._zstd().compressor.compress(data)
+        else:
+            # raw deflate: no zlib header or checksum, UDP has its own
+            if self.dictionary:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=self.dictionary)
+            else:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            packed = compressor.compress(data) + compressor.flush()
+        if len(packed) + 1 >= len(data):
+            return data
+        return self._marker + packed
+
+    def decompress(self, data):
+        if not data or data[0] != self.MARKER:
+            return data
+        if self.method == 'zstd':
+            data = data[1:]
+            if zstandard.frame_content_size(data) > self.max_size:
+                raise ValueError("compressed message is bigger than {} bytes".format(self.max_size))
+            return self._zstd().decompressor.decompress(data, max_output_size=self.max_size)
+        if self.dictionary:
+            decompressor = zlib.decompressobj(-15, zdict=self.dictionary)
+        else:
+            decompressor = zlib.decompressobj(-15)
+        message = decompressor.decompress(data[1:], self.max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError("compressed message is bigger than {} bytes".format(self.max_size))
+        if not decompressor.eof:
+            raise ValueError("compressed message is truncated")
+        return message
+
+
+def train_dictionary(samples, size=4096, method='zlib'):
+    """ Builds a preset dictionary from sample messages.
+
+        For zstd this is zstandard's trainer. For zlib it's the byte
+        sequences that show up in the most samples, with the most common
+        at the end of the dictionary, where they are cheapest to refer to.
+    """
+    if method == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs zstandard, `pip install zstandard`")
+        return zstandard.train_dictionary(size, list(samples)).as_bytes()
+
+    # count every 8 byte sequence once per sample it appears in
+    width = 8
+    counts = collections.Counter()
+    for sample in samples:
+        counts.update({bytes(sample[i:i + width]) for i in range(0, len(sample) - width + 1)})
+
+    chosen = []
+    text = b''
+    for sequence, count in counts.most_common():
+        if count < 2 or len(text) + width > size:
+            break
+        # overlapping sequences are often already in there
+        if sequence in text:
+            continue
+        chosen.append(sequence)
+        text += sequence
+    return b''.join(reversed(chosen))
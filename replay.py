@@ -0,0 +1,94 @@
+# replay.py
+#
+# Runs the example game on traffic captured with
+# `example_game_server.py --capture`, without any sockets, to reproduce and
+# profile what the server did. Game options after the capture are passed on
+# to the game, so a capture can be replayed against different settings.
+#
+# Example:
+#   python example_game_server.py --capture session.cap
+#   python replay.py info session.cap
+#   python replay.py replay session.cap --speed 0 --profile -- --coalesce
+#
+import argparse
+import cProfile
+import pstats
+import time
+from capture import read_capture, capture_segments, offline_server, replay
+from server import EventServer
+import example_game_server
+
+ARGS = argparse.ArgumentParser(description="Replay a packet capture")
+ARGS.add_argument('command', choices=["info", "replay"], help="Summarize the capture, or replay it into the game.")
+ARGS.add_argument('capture', help="Capture path, as given to --capture.")
+ARGS.add_argument('--speed', action="store", dest="speed", default="1", help="How much faster than real time to replay. 0 is as fast as possible.")
+ARGS.add_argument('--profile', action="store_true", dest="profile", help="Profile the replay and print the top functions.")
+
+
+def info(path):
+    segments = capture_segments(path)
+    if not segments:
+        print("No capture at {}".format(path))
+        return
+    inbound = outbound = bytes_in = bytes_out = 0
+    addresses = set()
+    first = last = None
+    for timestamp, is_outbound, address, data in read_capture(path):
+        if first is None:
+            first = timestamp
+        last = timestamp
+        addresses.add(address)
+        if is_outbound:
+            outbound += 1
+            bytes_out += len(data)
+        else:
+            inbound += 1
+            bytes_in += len(data)
+    duration = last - first if first is not None else 0
+    print("{}: {} segments, {:.1f}s, {} addresses".format(path, len(segments), duration, len(addresses)))
+    print("  in:  {} datagrams, {} bytes".format(inbound, bytes_in))
+    print("  out: {} datagrams, {} bytes".format(outbound, bytes_out))
+
+
+def run(path, speed, profile, game_args):
+    settings = example_game_server.ARGS.parse_args(game_args)
+    game = example_game_server.GameServer(settings)
+    server = offline_server(EventServer)
+    game.attach(server)
+
+    budget = 1.0 / game._tick_rate
+    overruns = [0]
+
+    def tick(dt):
+        start = time.perf_counter()
+        game.tick(dt)
+        if time.perf_counter() - start > budget:
+            overruns[0] += 1
+
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+    stats = replay(read_capture(path), server, speed, tick, game._tick_rate)
+    if profiler is not None:
+        profiler.disable()
+
+    ticks = game._tick_seconds
+    print("Replayed {:.1f}s of traffic in {:.2f}s: {} datagrams, {} ticks".format(
+        stats.duration, stats.wall_time, stats.inbound, stats.ticks))
+    print("  tick p50 {:.3f}ms  p99 {:.3f}ms  max {:.3f}ms  ({} of {} over the {:.1f}ms budget)".format(
+        ticks.percentile(0.5) * 1000, ticks.percentile(0.99) * 1000, ticks.max * 1000,
+        overruns[0], ticks.count, budget * 1000))
+    print("  sent {} datagrams, {} were sent when captured".format(
+        server.metrics.snapshot()['packets_out'], stats.recorded_outbound))
+
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+
+if __name__ == '__main__':
+    # anything we don't know is a game server option
+    args, game_args = ARGS.parse_known_args()
+    if args.command == "info":
+        info(args.capture)
+    else:
+        run(args.capture, float(args.speed), args.profile, [arg for arg in game_args if arg != '--'])
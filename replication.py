@@ -0,0 +1,152 @@
+# Snapshot replication
+#
+# Instead of sending the full state of every entity every tick, the server
+# remembers the last few snapshots it sent to each client and only sends the
+# fields that changed since the newest snapshot that client acknowledged.
+#
+# A snapshot is a dict of entity id -> tuple of (already quantized) field
+# values. On the wire a snapshot message is:
+#
+#   [sequence, baseline sequence (-1 for a full snapshot),
+#    [[entity id, changed field bitmask, changed values...], ...],
+#    [removed entity ids...]]
+#
+
+
+class ClientSnapshots:
+    """ Snapshots sent to one client, kept in a ring. """
+    __slots__ = ('ring', 'acked')
+
+    def __init__(self, history):
+        self.ring = [None] * history
+        # sequence of the newest snapshot the client told us it has
+        self.acked = -1
+
+
+class SnapshotReplicator:
+    def __init__(self, fields, history=32):
+        self.fields = fields
+        self.history = history
+        self.full_mask = (1 << len(fields)) - 1
+        self._sequence = 0
+        self._clients = {}
+
+    def next_sequence(self):
+        self._sequence += 1
+        return self._sequence
+
+    def add_client(self, client_id):
+        self._clients[client_id] = ClientSnapshots(self.history)
+
+    def remove_client(self, client_id):
+        self._clients.pop(client_id, None)
+
+    def ack(self, client_id, sequence):
+        client = self._clients.get(client_id)
+        if client is not None and sequence > client.acked:
+            client.acked = sequence
+
+    def baseline(self, client_id, sequence):
+        """ The acked snapshot to diff against, or None when the client
+            hasn't acked anything recent enough and needs a full snapshot.
+        """
+        client = self._clients[client_id]
+        if client.acked < 0 or sequence - client.acked >= self.history:
+            return None
+        entry = client.ring[client.acked % self.history]
+        if entry is None or entry[0] != client.acked:
+            return None
+        return entry
+
+    def encode(self, client_id, sequence, snapshot):
+        """ Builds the snapshot message for one client and remembers the
+            snapshot as sent.
+        """
+        message = self.delta(self.baseline(client_id, sequence), sequence, snapshot)
+        self.remember(client_id, sequence, snapshot)
+        return message
+
+    def remember(self, client_id, sequence, snapshot):
+        """ Records that `snapshot` was sent to the client as `sequence`. """
+        client = self._clients[client_id]
+        client.ring[sequence % self.history] = (sequence, snapshot)
+
+    def delta(self, baseline, sequence, snapshot):
+        """ Snapshot message for `snapshot` relative to a baseline returned
+            by baseline(). Clients with the same baseline can share it.
+
+            When nothing changed the message is still sent, with no entries,
+            so the client has a newer snapshot to ack and its baseline
+            doesn't fall out of the history.
+        """
+        if baseline is None:
+            return [sequence, -1, self._full_entries(snapshot), []]
+
+        baseline_sequence, baseline_state = baseline
+        entries = self._delta_entries(baseline_state, snapshot)
+        removed = [entity_id for entity_id in baseline_state if entity_id not in snapshot]
+        return [sequence, baseline_sequence, entries, removed]
+
+    def _full_entries(self, snapshot):
+        full_mask = self.full_mask
+        return [[entity_id, full_mask] + list(state) for entity_id, state in snapshot.items()]
+
+    def _delta_entries(self, baseline_state, snapshot):
+        full_mask = self.full_mask
+        entries = []
+        for entity_id, state in snapshot.items():
+            old = baseline_state.get(entity_id)
+            if old is None:
+                entries.append([entity_id, full_mask] + list(state))
+                continue
+            if old == state:
+                continue
+            mask = 0
+            entry = [entity_id, 0]
+            for i, value in enumerate(state):
+                if value != old[i]:
+                    mask |= 1 << i
+                    entry.append(value)
+            entry[1] = mask
+            entries.append(entry)
+        return entries
+
+
+class SnapshotReceiver:
+    """ Client side: rebuilds snapshots from snapshot messages. """
+    def __init__(self, fields, history=32):
+        self.fields = fields
+        self.history = history
+        self._ring = [None] * history
+        self.latest = -1
+
+    def apply(self, message):
+        """ Returns (sequence, snapshot dict), or None if the baseline is
+            gone (the server will send a full snapshot once our acks stop
+            matching).
+        """
+        sequence, baseline_sequence, entries, removed = message
+        if baseline_sequence < 0:
+            state = {}
+        else:
+            entry = self._ring[baseline_sequence % self.history]
+            if entry is None or entry[0] != baseline_sequence:
+                return None
+            state = dict(entry[1])
+
+        for entity_id in removed:
+            state.pop(entity_id, None)
+
+        for entry in entries:
+            entity_id, mask = entry[0], entry[1]
+            values = list(state.get(entity_id, (0,) * len(self.fields)))
+            changed = iter(entry[2:])
+            for i in range(len(self.fields)):
+                if mask & (1 << i):
+                    values[i] = next(changed)
+            state[entity_id] = tuple(values)
+
+        self._ring[sequence % self.history] = (sequence, state)
+        if sequence > self.latest:
+            self.latest = sequence
+        return sequence, state
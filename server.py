@@ -2,68 +2,1685 @@
 #
 # Ctrl+C to kill
 #
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import hmac
+import http.server
+import os
+import queue
 import socketserver
 import socket
+import struct
 import threading
+import traceback
 import json
+import math
 from message import MessageProtocol
 import time
-import sys
 
 
-class ThreadedUDPServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
+# First byte of a datagram that carries several messages. 0xC1 is never
+# used by msgpack and can't start a JSON or BinaryProtocol message.
+COALESCED = 0xC1
+_COALESCED_LENGTH = struct.Struct(">H")
 
-    def __init__(self, server_address, bind_and_activate=True):
-        """Constructor.  May be extended, do not override."""
-        socketserver.UDPServer.__init__(self, server_address, None, bind_and_activate)
+
+def coalesce(items, max_size):
+    """ Packs (data, address) pairs going to the same address into as few
+        datagrams of at most `max_size` bytes as possible. Each datagram is
+        COALESCED followed by (2 byte length, message) pairs. Messages that
+        end up alone, or are too big to share, are sent as they are.
+        Messages to one address stay in the order they were given.
+    """
+    out = []
+    # address -> [datagram being built, its first message, message count]
+    open_datagrams = {}
+    for data, address in items:
+        current = open_datagrams.get(address)
+        if len(data) + 3 > max_size:
+            # what came before it goes first
+            if current is not None:
+                out.append((current[0] if current[2] > 1 else current[1], address))
+                del open_datagrams[address]
+            out.append((data, address))
+            continue
+        if current is not None and len(current[0]) + 2 + len(data) > max_size:
+            out.append((current[0] if current[2] > 1 else current[1], address))
+            current = None
+        if current is None:
+            current = open_datagrams[address] = [bytearray((COALESCED,)), data, 0]
+        current[0] += _COALESCED_LENGTH.pack(len(data))
+        current[0] += data
+        current[2] += 1
+    for address, current in open_datagrams.items():
+        out.append((current[0] if current[2] > 1 else current[1], address))
+    return out
+
+
+def split_datagram(data):
+    """ The messages in a datagram, undoing coalesce(). """
+    if data[:1] != b'\xc1':
+        return [data]
+    messages = []
+    offset = 1
+    end = len(data)
+    while offset + 2 <= end:
+        length, = _COALESCED_LENGTH.unpack_from(data, offset)
+        offset += 2
+        messages.append(data[offset:offset + length])
+        offset += length
+    return messages
+
+
+# First byte of a fragment of a message too big for one datagram. On its
+# own 0xC3 is a msgpack `true`, which no protocol sends as a whole message.
+FRAGMENT = 0xC3
+# marker, flags, message id, fragment index, fragment count
+_FRAGMENT_HEADER = struct.Struct(">BBHBB")
+# marker, flags, message id, bitfield of the fragments received
+_FRAGMENT_ACK = struct.Struct(">BBHQ")
+_FRAGMENT_RELIABLE = 0x01
+_FRAGMENT_IS_ACK = 0x02
+MAX_FRAGMENTS = 64
+
+
+class SentMessage:
+    """ A reliable fragmented message, kept until every fragment is acked. """
+    __slots__ = ('message_id', 'datagrams', 'acked', 'sent_at', 'key')
+
+    def __init__(self, message_id, datagrams, sent_at, key):
+        self.message_id = message_id
+        self.datagrams = datagrams
+        self.acked = 0
+        self.sent_at = sent_at
+        self.key = key
+
+
+class Fragmenter:
+    """ Splits messages into numbered fragments that each fit in a datagram.
+
+        Reliable messages are remembered (up to `max_pending`, for at most
+        `timeout` seconds) along with which fragments the receiver acked.
+        Sending the exact same bytes to the same address again, as a
+        reliable layer does when it resends, only sends the fragments that
+        weren't acked.
+    """
+    def __init__(self, max_pending=256, timeout=10.0):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        # address -> next message id. Ids are per address so that one
+        # receiver's ids only wrap after 65536 messages to it.
+        self._message_ids = {}
+        # (address, data) -> SentMessage, oldest first
+        self._sent = collections.OrderedDict()
+        # (address, message id) -> SentMessage
+        self._by_id = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sent)
+
+    def split(self, address, data, max_size, reliable=False, now=0.0):
+        """ The datagrams to send for `data`. """
+        if reliable:
+            data = bytes(data)
+            with self._lock:
+                sent = self._sent.get((address, data))
+                if sent is not None:
+                    return [datagram for i, datagram in enumerate(sent.datagrams)
+                            if not sent.acked & (1 << i)]
+
+        chunk = max_size - _FRAGMENT_HEADER.size
+        count = -(-len(data) // chunk)
+        if count > MAX_FRAGMENTS:
+            raise ValueError("message of {} bytes needs more than {} fragments".format(len(data), MAX_FRAGMENTS))
+        with self._lock:
+            message_id = self._message_ids.get(address, 0)
+            self._message_ids[address] = (message_id + 1) & 0xFFFF
+        flags = _FRAGMENT_RELIABLE if reliable else 0
+        datagrams = [_FRAGMENT_HEADER.pack(FRAGMENT, flags, message_id, i, count) + data[i * chunk:(i + 1) * chunk]
+                     for i in range(count)]
+
+        if reliable:
+            key = (address, data)
+            with self._lock:
+                self._expire(now)
+                sent = SentMessage(message_id, datagrams, now, key)
+                self._sent[key] = sent
+                self._by_id[(address, message_id)] = sent
+        return datagrams
+
+    def acked(self, address, datagram):
+        """ Handles a fragment ack from the receiver. """
+        _, _, message_id, bits = _FRAGMENT_ACK.unpack_from(datagram)
+        with self._lock:
+            sent = self._by_id.get((address, message_id))
+            if sent is None:
+                return
+            sent.acked |= bits
+            if sent.acked == (1 << len(sent.datagrams)) - 1:
+                self._remove(sent)
+
+    def forget(self, address):
+        with self._lock:
+            self._message_ids.pop(address, None)
+            for sent in [sent for key, sent in self._sent.items() if key[0] == address]:
+                self._remove(sent)
+
+    def _remove(self, sent):
+        del self._sent[sent.key]
+        del self._by_id[(sent.key[0], sent.message_id)]
+
+    def _expire(self, now):
+        while self._sent:
+            sent = next(iter(self._sent.values()))
+            if len(self._sent) < self.max_pending and now - sent.sent_at < self.timeout:
+                return
+            self._remove(sent)
+
+
+# roughly what a PartialMessage costs before any fragment arrives: the
+# object itself plus one list slot per fragment
+_PARTIAL_OVERHEAD = 128
+_PARTIAL_SLOT = 8
+
+
+class PartialMessage:
+    """ The fragments of one message received so far. """
+    __slots__ = ('fragments', 'count', 'received', 'bits', 'size', 'created')
+
+    def __init__(self, count, now):
+        self.fragments = [None] * count
+        self.count = count
+        self.received = 0
+        self.bits = 0
+        # bytes charged against the Reassembler's `max_bytes`
+        self.size = _PARTIAL_OVERHEAD + count * _PARTIAL_SLOT
+        self.created = now
+
+
+class Reassembler:
+    """ Puts fragmented messages back together.
+
+        Memory is bounded: at most `max_bytes` are buffered, counting each
+        partial message's own overhead as well as its fragments, and at
+        most `max_partials` messages are in progress (the oldest partial
+        messages are dropped first). An address can only have
+        `max_per_address` messages in progress (starting another drops its
+        oldest), and a message that isn't complete after `timeout` seconds
+        is dropped. Empty fragments are ignored. `dropped` counts dropped
+        messages.
+
+        The ids of completed messages are remembered for `timeout` seconds
+        too (at most `max_completed` of them), so a resent fragment is
+        acked again but not delivered twice. They don't count towards
+        either limit.
+    """
+    def __init__(self, max_bytes=4 * 1024 * 1024, max_per_address=8, timeout=5.0, max_completed=65536,
+                 max_partials=4096):
+        self.max_bytes = max_bytes
+        self.max_partials = max_partials
+        self.max_per_address = max_per_address
+        self.timeout = timeout
+        self.max_completed = max_completed
+        self.dropped = 0
+        # (address, message id) -> PartialMessage, oldest first
+        self._partials = collections.OrderedDict()
+        # address -> keys of its messages in progress, oldest first
+        self._per_address = {}
+        # (address, message id) -> (completed at, fragment count), oldest first
+        self._completed = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._partials)
+
+    def add(self, address, datagram, now):
+        """ Handles one fragment. Returns (the whole message if this
+            fragment completed it or None, the ack to send back or None).
+        """
+        if len(datagram) <= _FRAGMENT_HEADER.size:
+            return None, None
+        _, flags, message_id, index, count = _FRAGMENT_HEADER.unpack_from(datagram)
+        if count == 0 or count > MAX_FRAGMENTS or index >= count:
+            return None, None
+        key = (address, message_id)
+        reliable = flags & _FRAGMENT_RELIABLE
+        with self._lock:
+            self._expire(now)
+            completed = self._completed.get(key)
+            if completed is not None:
+                if completed[1] == count:
+                    # a resend of a message we already have
+                    if reliable:
+                        return None, _FRAGMENT_ACK.pack(FRAGMENT, _FRAGMENT_IS_ACK, message_id, (1 << count) - 1)
+                    return None, None
+                # the message id wrapped around
+                del self._completed[key]
+
+            partial = self._partials.get(key)
+            if partial is not None and partial.count != count:
+                # the message id wrapped around
+                self.dropped += 1
+                self._remove(key)
+                partial = None
+            if partial is None:
+                keys = self._per_address.setdefault(address, [])
+                if len(keys) >= self.max_per_address:
+                    self.dropped += 1
+                    self._remove(keys[0])
+                    keys = self._per_address.setdefault(address, [])
+                partial = self._partials[key] = PartialMessage(count, now)
+                keys.append(key)
+                self._bytes += partial.size
+
+            message = None
+            bit = 1 << index
+            if not partial.bits & bit:
+                fragment = bytes(datagram[_FRAGMENT_HEADER.size:])
+                partial.fragments[index] = fragment
+                partial.bits |= bit
+                partial.received += 1
+                partial.size += len(fragment)
+                self._bytes += len(fragment)
+                if partial.received == count:
+                    message = b''.join(partial.fragments)
+                    self._remove(key)
+                    self._completed[key] = (now, count)
+                    if len(self._completed) > self.max_completed:
+                        self._completed.popitem(last=False)
+
+            ack = None
+            if reliable:
+                ack = _FRAGMENT_ACK.pack(FRAGMENT, _FRAGMENT_IS_ACK, message_id, partial.bits)
+
+            while self._bytes > self.max_bytes or len(self._partials) > self.max_partials:
+                self.dropped += 1
+                self._remove(next(iter(self._partials)))
+        return message, ack
+
+    def _remove(self, key):
+        partial = self._partials.pop(key)
+        self._bytes -= partial.size
+        keys = self._per_address[key[0]]
+        keys.remove(key)
+        if not keys:
+            del self._per_address[key[0]]
+
+    def _expire(self, now):
+        partials = self._partials
+        while partials:
+            key, partial = next(iter(partials.items()))
+            if now - partial.created < self.timeout:
+                break
+            self.dropped += 1
+            self._remove(key)
+        completed = self._completed
+        while completed:
+            key, (completed_at, _) = next(iter(completed.items()))
+            if now - completed_at < self.timeout:
+                break
+            del completed[key]
+
+
+def is_fragment_ack(datagram):
+    return datagram[1] & _FRAGMENT_IS_ACK
+
+
+class Counter:
+    """ A number that only goes up.
+
+        Updates aren't locked. Under the GIL a concurrent increment can, very
+        rarely, be lost, which is fine for metrics and keeps the hot path
+        to a single add.
+    """
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """ A number that goes up and down. Either set() it, or give it a
+        function that is called whenever the gauge is read.
+    """
+    kind = 'gauge'
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Histogram:
+    """ Log-linear histogram of durations, in the spirit of HdrHistogram.
+
+        Values are recorded in microseconds into buckets that are linear
+        within each power of two (16 per power), so recording is O(1) and
+        percentiles are accurate to about 6% at any scale.
+    """
+    kind = 'summary'
+    SUB_BUCKETS = 16
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self):
+        self.counts = [0] * (self.SUB_BUCKETS * 42)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        micros = int(seconds * 1000000)
+        if micros < self.SUB_BUCKETS:
+            index = max(micros, 0)
+        else:
+            shift = micros.bit_length() - 5
+            index = self.SUB_BUCKETS * (shift + 1) + (micros >> shift) - self.SUB_BUCKETS
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def _bucket_value(self, index):
+        """ Upper end of a bucket, in seconds. """
+        if index < self.SUB_BUCKETS:
+            return index / 1000000
+        shift = index // self.SUB_BUCKETS - 1
+        sub = index % self.SUB_BUCKETS + self.SUB_BUCKETS
+        return (((sub + 1) << shift) - 1) / 1000000
+
+    def percentile(self, quantile):
+        if self.count == 0:
+            return 0.0
+        target = max(1, int(math.ceil(quantile * self.count)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def snapshot(self):
+        snapshot = {"count": self.count, "sum": self.sum, "max": self.max}
+        for quantile in self.QUANTILES:
+            snapshot["p{:g}".format(quantile * 100)] = self.percentile(quantile)
+        return snapshot
+
+
+class Metrics:
+    """ Registry of named metrics.
+
+        Metrics are created on first use, e.g.
+
+            metrics.counter('packets_in').inc()
+            metrics.histogram('handler_seconds', event='JOIN').record(0.001)
+
+        snapshot() returns every value in a dict (handy for tests) and
+        prometheus_text() renders them in the Prometheus text format.
+    """
+    def __init__(self, prefix='udp_'):
+        self.prefix = prefix
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, labels, help_text, *args):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls(*args)
+                    if help_text:
+                        self._help[name] = help_text
+        return metric
+
+    def counter(self, name, help_text=None, **labels):
+        return self._get(Counter, name, labels, help_text)
+
+    def gauge(self, name, help_text=None, function=None, **labels):
+        return self._get(Gauge, name, labels, help_text, function)
+
+    def histogram(self, name, help_text=None, **labels):
+        return self._get(Histogram, name, labels, help_text)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + "}"
+
+    def snapshot(self):
+        return {name + self._labels(labels): metric.snapshot()
+                for (name, labels), metric in list(self._metrics.items())}
+
+    def prometheus_text(self):
+        lines = []
+        typed = set()
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda item: item[0]):
+            full_name = self.prefix + name
+            if name not in typed:
+                typed.add(name)
+                if name in self._help:
+                    lines.append("# HELP {} {}".format(full_name, self._help[name]))
+                lines.append("# TYPE {} {}".format(full_name, metric.kind))
+            if isinstance(metric, Histogram):
+                for quantile in metric.QUANTILES:
+                    lines.append("{}{} {}".format(full_name, self._labels(labels, [("quantile", quantile)]), metric.percentile(quantile)))
+                lines.append("{}_sum{} {}".format(full_name, self._labels(labels), metric.sum))
+                lines.append("{}_count{} {}".format(full_name, self._labels(labels), metric.count))
+            else:
+                lines.append("{}{} {}".format(full_name, self._labels(labels), metric.snapshot()))
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(metrics, address=('127.0.0.1', 9100)):
+    """ Serves metrics.prometheus_text() at http://<address>/metrics on a
+        background thread. Returns the HTTP server; call shutdown() on it
+        to stop.
+    """
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(address, MetricsHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd
+
+
+# Flood protection
+#
+# Both of these run in verify_request(), before a handler thread is started
+# or a byte of the message is parsed, so rejecting a datagram costs a dict
+# lookup and a little arithmetic.
+
+class TokenBucketLimiter:
+    """ A token bucket per address: `rate` datagrams a second, with bursts
+        of up to `burst`. Datagrams over the limit are dropped.
+
+        Only `max_addresses` buckets are kept. Addresses whose bucket has
+        filled back up are forgotten (a new bucket is exactly the same), and
+        when every bucket is busy, new addresses are dropped until some
+        calm down. Not thread-safe; it's only called from the thread reading
+        the socket.
+    """
+    def __init__(self, rate, burst=None, max_addresses=65536):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.max_addresses = max_addresses
+        # address -> [tokens, last refill]
+        self._buckets = {}
+        self._next_prune = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, address, now):
+        bucket = self._buckets.get(address)
+        if bucket is None:
+            if len(self._buckets) >= self.max_addresses and not self._prune(now):
+                return False
+            self._buckets[address] = [self.burst - 1, now]
+            return True
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def _prune(self, now):
+        """ Forgets every full bucket. Returns True if that made room. """
+        if now < self._next_prune:
+            return False
+        refill_time = self.burst / self.rate
+        self._next_prune = now + refill_time
+        self._buckets = {address: bucket for address, bucket in self._buckets.items()
+                         if now - bucket[1] < refill_time}
+        return len(self._buckets) < self.max_addresses
+
+
+# First byte of handshake datagrams. On its own 0xC2 is a msgpack `false`,
+# which no protocol sends as a whole message.
+HANDSHAKE = 0xC2
+_HELLO = 0
+_CHALLENGE = 1
+_RESPONSE = 2
+_ACCEPTED = 3
+
+
+class CookieHandshake:
+    """ Stateless connect handshake.
+
+        Datagrams from an address that hasn't been admitted yet are never
+        handed to message_received(). Instead they are answered with a
+        challenge holding a cookie: an HMAC of the address and the current
+        time window. The client has to send the cookie back, proving it can
+        receive at that address, before it's admitted. Nothing is stored
+        for an address until then, so spoofed floods can't use up memory.
+
+        A challenge is never bigger than the datagram that caused it, so
+        the server can't be used to amplify traffic at a spoofed address.
+
+        An admitted address that sends nothing for `idle_timeout` seconds
+        has to handshake again, and at most `max_admitted` addresses are
+        kept (the longest quiet is dropped first), so clients that left
+        without saying so don't stay admitted forever.
+    """
+    COOKIE_SIZE = 8
+
+    def __init__(self, lifetime=10.0, secret=None, idle_timeout=60.0, max_admitted=65536):
+        # cookies are good for between one and two lifetimes
+        self.lifetime = lifetime
+        self.idle_timeout = idle_timeout
+        self.max_admitted = max_admitted
+        self._secret = secret if secret is not None else os.urandom(16)
+        # address -> last heard from, quietest first
+        self.admitted = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.admitted)
+
+    def cookie(self, address, now, window=0):
+        epoch = int(now // self.lifetime) - window
+        text = "{}:{}:{}".format(address[0], address[1], epoch).encode()
+        return hmac.new(self._secret, text, hashlib.sha256).digest()[:self.COOKIE_SIZE]
+
+    def is_admitted(self, address, now):
+        """ True if `address` is admitted, and notes that it was heard from. """
+        with self._lock:
+            self._expire(now)
+            if address not in self.admitted:
+                return False
+            self.admitted[address] = now
+            self.admitted.move_to_end(address)
+            return True
+
+    def forget(self, address):
+        with self._lock:
+            self.admitted.pop(address, None)
+
+    def _admit(self, address, now):
+        with self._lock:
+            self._expire(now)
+            self.admitted[address] = now
+            self.admitted.move_to_end(address)
+            while len(self.admitted) > self.max_admitted:
+                self.admitted.popitem(last=False)
+
+    def _expire(self, now):
+        admitted = self.admitted
+        while admitted:
+            address, last_seen = next(iter(admitted.items()))
+            if now - last_seen < self.idle_timeout:
+                break
+            del admitted[address]
+
+    def handle(self, data, address, now):
+        """ Handles a datagram from an address that isn't admitted (or a
+            stray handshake datagram from one that is). Returns the reply
+            to send, or None.
+        """
+        if len(data) == 2 + self.COOKIE_SIZE and data[0] == HANDSHAKE and data[1] == _RESPONSE:
+            cookie = bytes(data[2:])
+            if (hmac.compare_digest(cookie, self.cookie(address, now)) or
+                    hmac.compare_digest(cookie, self.cookie(address, now, 1))):
+                self._admit(address, now)
+                return bytes((HANDSHAKE, _ACCEPTED))
+        if address in self.admitted:
+            return bytes((HANDSHAKE, _ACCEPTED)) if data and data[0] == HANDSHAKE else None
+        if len(data) < 2 + self.COOKIE_SIZE:
+            return None
+        return bytes((HANDSHAKE, _CHALLENGE)) + self.cookie(address, now)
+
+
+def handshake_reply(data):
+    """ Client side: the answer to a handshake datagram from the server, or
+        None if there's nothing to answer (it was an accept).
+    """
+    if len(data) == 2 + CookieHandshake.COOKIE_SIZE and data[0] == HANDSHAKE and data[1] == _CHALLENGE:
+        return bytes((HANDSHAKE, _RESPONSE)) + bytes(data[2:])
+    return None
+
+
+def client_handshake(sock, address, timeout=0.5, attempts=10):
+    """ Client side: runs the handshake on a UDP socket. Blocks until the
+        server admits us, up to `attempts` tries. Returns True on success.
+    """
+    hello = bytes((HANDSHAKE, _HELLO)) + bytes(CookieHandshake.COOKIE_SIZE)
+    old_timeout = sock.gettimeout()
+    sock.settimeout(timeout)
+    try:
+        message = hello
+        for _ in range(attempts):
+            sock.sendto(message, address)
+            try:
+                data, _ = sock.recvfrom(64)
+            except socket.timeout:
+                message = hello
+                continue
+            if len(data) >= 2 and data[0] == HANDSHAKE and data[1] == _ACCEPTED:
+                return True
+            message = handshake_reply(data) or hello
+        return False
+    finally:
+        sock.settimeout(old_timeout)
+
+
+class FloodGuardMixIn:
+    """ Rejects datagrams before they are handled.
+
+        Set `limiter` to a TokenBucketLimiter to rate limit every address,
+        and `handshake` to a CookieHandshake to only let admitted clients
+        through. Both are off by default.
+    """
+    limiter = None
+    handshake = None
+
+    def _init_flood_guard(self):
+        self._rate_limited = self.metrics.counter('rate_limited', 'Datagrams dropped by the rate limiter')
+        self._challenges = self.metrics.counter('handshake_challenges', 'Datagrams from unadmitted addresses')
+
+    def verify_request(self, request, client_address):
+        limiter = self.limiter
+        handshake = self.handshake
+        if limiter is None and handshake is None:
+            return True
+        now = self.clock()
+        if limiter is not None and not limiter.allow(client_address, now):
+            self._rate_limited.inc()
+            return False
+        if handshake is not None:
+            data = request[0]
+            if not handshake.is_admitted(client_address, now) or (data and data[0] == HANDSHAKE):
+                self._challenges.inc()
+                reply = handshake.handle(data, client_address, now)
+                if reply is not None:
+                    self.sendto(client_address, reply)
+                return False
+        return True
+
+    def forget_address(self, address):
+        """ Called when a client goes away; it has to handshake again. """
+        if self.handshake is not None:
+            self.handshake.forget(address)
+
+
+class CountingMixIn:
+    """ The bookkeeping every transport shares: the `metrics` registry,
+        counting (and capturing) what is received and sent, and the debug
+        size printouts.
+    """
+    capture = None
+
+    def _init_counters(self):
+        self.metrics = Metrics()
+        self._packets_in = self.metrics.counter('packets_in', 'Datagrams received')
+        self._bytes_in = self.metrics.counter('bytes_in', 'Bytes received')
+        self._packets_out = self.metrics.counter('packets_out', 'Datagrams sent')
+        self._bytes_out = self.metrics.counter('bytes_out', 'Bytes sent')
+        self._send_dropped = self.metrics.counter('send_dropped', 'Datagrams dropped because the socket buffer was full')
 
         # Debug settings
         self.debug_message_size = False
 
+    def finish_request(self, request, socket_address):
+        self._packets_in.inc()
+        self._bytes_in.inc(len(request[0]))
+
+        if self.debug_message_size:
+            print("[SOCKET INCOMING SIZE] {}".format(len(request[0])))
+
+        self.message_received(request[0], socket_address)
+
+    def _count_sent(self, items):
+        """ Counts (data, address) pairs that are about to be sent. """
+        self._packets_out.inc(len(items))
+        self._bytes_out.inc(sum(len(data) for data, _ in items))
+        if self.capture is not None:
+            now = self.clock()
+            for data, address in items:
+                self.capture.outbound(address, data, now)
+
+
+class SendBatchMixIn:
+    """ SendBatchMixIn
+
+        Lets a thread queue up every datagram it sends between begin_batch()
+        and flush(), so a whole tick of outgoing packets goes out in one
+        tight loop instead of being interleaved with game logic.
+        Batches are per-thread; other threads keep sending immediately.
+
+        With `coalesce` on, everything in a batch going to the same address
+        is packed into as few datagrams of `max_datagram_size` as possible
+        (see coalesce()). The EventServer splits them back up on receive.
+    """
+    coalesce = False
+    max_datagram_size = 1200
+
+    def begin_batch(self):
+        self._batches.pending = []
+
+    def flush(self):
+        """ Sends everything queued on this thread since begin_batch()."""
+        items = getattr(self._batches, 'pending', None)
+        self._batches.pending = None
+        if items:
+            if self.coalesce:
+                items = coalesce(items, self.max_datagram_size)
+            self._count_sent(items)
+            self._send_batch(items)
+
+    def _pending_batch(self):
+        return getattr(self._batches, 'pending', None)
+
+    def _batch_or_count(self, address, data):
+        """ The bookkeeping for one sendto(): returns True if the datagram
+            was queued on this thread's batch instead of being sent now,
+            otherwise counts it as sent and returns False.
+        """
+        if self.debug_message_size:
+            print("[SOCKET OUTGOING SIZE] {}".format(len(data)))
+        batch = self._pending_batch()
+        if batch is not None:
+            batch.append((data, address))
+            return True
+        self._count_sent(((data, address),))
+        return False
+
+    def _send_batch(self, items):
+        sendto = self.socket.sendto
+        for data, address in items:
+            try:
+                sendto(data, address)
+            except BlockingIOError:
+                # socket buffer is full, drop it like the network would
+                self._send_dropped.inc()
+
+
+class BufferPool:
+    """ Receive buffers carved out of one preallocated slab.
+
+        acquire() hands out a memoryview of `size` bytes to recvfrom_into(),
+        release() gives it back. When every buffer is in use a new one is
+        allocated (and counted in `misses`) rather than blocking. Safe to
+        release from any thread.
+    """
+    def __init__(self, count=256, size=8192):
+        self.count = count
+        self.size = size
+        self.misses = 0
+        self._slab = bytearray(count * size)
+        view = memoryview(self._slab)
+        self._free = [view[i * size:(i + 1) * size] for i in range(count)]
+
+    def __len__(self):
+        """ Buffers available. """
+        return len(self._free)
+
+    def acquire(self):
+        try:
+            return self._free.pop()
+        except IndexError:
+            self.misses += 1
+            return memoryview(bytearray(self.size))
+
+    def release(self, buffer):
+        if len(self._free) < self.count:
+            self._free.append(buffer)
+
+
+class ThreadedUDPServer(FloodGuardMixIn, SendBatchMixIn, CountingMixIn, socketserver.ThreadingMixIn, socketserver.UDPServer):
+    """ ThreadedUDPServer
+
+        Handles every datagram on its own thread.
+
+        Set `buffer_pool` to a BufferPool to receive without allocating: the
+        data handed to message_received() is then a memoryview that is
+        reused once the handler returns, so handlers must copy (bytes(data))
+        anything they want to keep.
+
+        Set `capture` to a capture.CaptureWriter to record every datagram
+        received and sent.
+
+        The server talks to the network through `transport`, which is a UDP
+        socket unless another one is given: anything with a socket's
+        sendto(), recvfrom(), recvfrom_into(), getsockname(), setblocking()
+        and close(), like a loopback.LoopbackSocket. Without a real socket
+        serve_forever() can't wait for datagrams; call handle_pending()
+        instead. `clock` is where the server gets the time from.
+    """
+    buffer_pool = None
+
+    def __init__(self, server_address, bind_and_activate=True, transport=None):
+        """Constructor.  May be extended, do not override."""
+        if transport is None:
+            socketserver.UDPServer.__init__(self, server_address, None, bind_and_activate)
+        else:
+            socketserver.UDPServer.__init__(self, server_address, None, False)
+            self.socket.close()
+            self.socket = transport
+            self.server_address = transport.getsockname()
+        self.clock = time.monotonic
+
+        # per-thread outgoing batches, see begin_batch()
+        self._batches = threading.local()
+
+        self._init_counters()
+        self._init_flood_guard()
+
     def service_actions(self):
         """Called by the server_forever() loop"""
         pass
 
-    def finish_request(self, request, socket_address):
+    def get_request(self):
+        """ With a `buffer_pool`, datagrams are read straight into a pooled
+            buffer and handlers get a memoryview of it. The request carries
+            the buffer as a third item so shutdown_request() can give it
+            back.
+        """
+        pool = self.buffer_pool
+        if pool is None:
+            request, client_address = socketserver.UDPServer.get_request(self)
+        else:
+            buffer = pool.acquire()
+            try:
+                nbytes, client_address = self.socket.recvfrom_into(buffer)
+            except OSError:
+                pool.release(buffer)
+                raise
+            request = (buffer[:nbytes], self.socket, buffer)
+        if self.capture is not None:
+            self.capture.inbound(client_address, request[0], self.clock())
+        return request, client_address
 
-        if self.debug_message_size:
-            print("[SOCKET INCOMING SIZE] {}".format(sys.getsizeof(request[0])))
+    def shutdown_request(self, request):
+        """ Called once a request has been handled (or rejected). """
+        if len(request) > 2:
+            self.buffer_pool.release(request[2])
 
-        self.message_received(request[0], socket_address)
+    def handle_pending(self, max_requests=None):
+        """ Reads up to `max_requests` datagrams that are already waiting
+            (all of them by default) and handles them in order on this
+            thread. Returns how many were read.
+        """
+        get_request = self.get_request
+        batch = []
+        reads = 0
+        while max_requests is None or reads < max_requests:
+            reads += 1
+            try:
+                batch.append(get_request())
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionError:
+                # ICMP errors from clients that went away
+                continue
+            except OSError:
+                # the socket itself is broken, e.g. closed
+                break
+
+        for request, socket_address in batch:
+            try:
+                if self.verify_request(request, socket_address):
+                    self.finish_request(request, socket_address)
+            except Exception:
+                self.handle_error(request, socket_address)
+            finally:
+                self.shutdown_request(request)
+        return len(batch)
 
     def sendto(self, address, data):
         """Send data to specific address"""
-        if self.debug_message_size:
-            print("[SOCKET OUTGOING SIZE] {}".format(sys.getsizeof(data)))
+        if self._batch_or_count(address, data):
+            return
         self.socket.sendto(data, address)
 
+    def _schedule_coroutine(self, coro):
+        """ Async handlers are run to completion on the handling thread."""
+        asyncio.run(coro)
+
     def message_received(self, data, socket_address):
         """ This is called when we receive data. Override this. """
         pass
 
 
-class EventServer(ThreadedUDPServer):
-    """ EventServer
+class BatchUDPServer(ThreadedUDPServer):
+    """ BatchUDPServer
+
+        Instead of one thread per datagram, the serve_forever() thread
+        drains up to `batch_size` datagrams every time the socket becomes
+        readable and handles them in order on that thread.
+    """
+    def __init__(self, server_address, bind_and_activate=True, batch_size=64, transport=None):
+        ThreadedUDPServer.__init__(self, server_address, bind_and_activate, transport)
+        self.batch_size = batch_size
+        self.socket.setblocking(False)
+
+    def _handle_request_noblock(self):
+        """ Called by serve_forever() when the socket is readable."""
+        self.handle_pending(self.batch_size)
+
+
+class WorkerPoolMixIn:
+    """ Mix-in class to handle each request on a fixed-size worker pool.
+
+        The serve_forever() thread only reads datagrams. Each one is put on
+        the bounded queue of the worker picked by its address, so requests
+        from one client are always handled in order by the same worker.
+        When a queue is full, `overload_policy` decides what happens:
+        DROP_OLDEST, DROP_NEWEST or BLOCK (the reader waits).
+    """
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    BLOCK = 'block'
+
+    pool_workers = 4
+    pool_queue_size = 1024
+    overload_policy = DROP_OLDEST
+
+    def _start_pool(self):
+        self._pool_queues = [queue.Queue(self.pool_queue_size) for _ in range(self.pool_workers)]
+        self._requests_dropped = self.metrics.counter('requests_dropped', 'Datagrams dropped by the overload policy')
+        self.metrics.gauge('pool_queue_depth', 'Datagrams waiting for a worker',
+                           function=lambda: sum(q.qsize() for q in self._pool_queues))
+        self._pool = concurrent.futures.ThreadPoolExecutor(self.pool_workers)
+        for q in self._pool_queues:
+            self._pool.submit(self._pool_worker, q)
+
+    @property
+    def dropped_requests(self):
+        return self._requests_dropped.value
+
+    def process_request(self, request, client_address):
+        q = self._pool_queues[hash(client_address) % self.pool_workers]
+        item = (request, client_address)
+        if self.overload_policy == self.BLOCK:
+            q.put(item)
+            return
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                self._requests_dropped.inc()
+                if self.overload_policy == self.DROP_NEWEST:
+                    self.shutdown_request(request)
+                    return
+                try:
+                    dropped, _ = q.get_nowait()
+                    self.shutdown_request(dropped)
+                except queue.Empty:
+                    pass
+
+    def _pool_worker(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for q in self._pool_queues:
+            q.put(None)
+        self._pool.shutdown(wait=True)
+
+
+class PooledUDPServer(WorkerPoolMixIn, ThreadedUDPServer):
+    """ PooledUDPServer
+
+        ThreadedUDPServer that hands datagrams to a fixed pool of worker
+        threads instead of starting a thread per datagram.
+    """
+    def __init__(self, server_address, bind_and_activate=True, workers=None, queue_size=None, overload_policy=None,
+                 transport=None):
+        if workers is not None:
+            self.pool_workers = workers
+        if queue_size is not None:
+            self.pool_queue_size = queue_size
+        if overload_policy is not None:
+            self.overload_policy = overload_policy
+        ThreadedUDPServer.__init__(self, server_address, bind_and_activate, transport)
+        self._start_pool()
+
+
+class AsyncUDPServer(FloodGuardMixIn, SendBatchMixIn, CountingMixIn):
+    """ AsyncUDPServer
 
-        Builds off of the ThreadedUDPServer to add an "event message" system,
-        as well as a heartbeat system (automatically considers endpoints
-        "disconnected" if they haven't talked to us in a while.
+        Same surface as the ThreadedUDPServer (serve_forever, shutdown,
+        sendto, message_received), but datagrams are read by an asyncio
+        DatagramProtocol on a single event loop instead of spawning a
+        thread per datagram.
     """
     def __init__(self, server_address, bind_and_activate=True):
-        ThreadedUDPServer.__init__(self, server_address, bind_and_activate)
+        self.server_address = server_address
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if bind_and_activate:
+            try:
+                self.server_bind()
+            except:
+                self.server_close()
+                raise
+
+        self.clock = time.monotonic
+        self.loop = None
+        self.transport = None
+        self._loop_thread = None
+        self._shutdown_request = None
+        self._is_shut_down = threading.Event()
+        self._is_shut_down.set()
+
+        # per-thread outgoing batches, see begin_batch()
+        self._batches = threading.local()
+
+        self._init_counters()
+        self._init_flood_guard()
+
+    def server_bind(self):
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+
+    def server_close(self):
+        self.socket.close()
+
+    def serve_forever(self, poll_interval=0.5):
+        """ Runs an event loop in the calling thread until shutdown()."""
+        self._is_shut_down.clear()
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.get_ident()
+        try:
+            self.loop.run_until_complete(self._serve(poll_interval))
+        finally:
+            self.loop.close()
+            self.loop = None
+            self._loop_thread = None
+            self._is_shut_down.set()
+
+    async def _serve(self, poll_interval):
+        self._shutdown_request = self.loop.create_future()
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _ServerDatagramProtocol(self), sock=self.socket)
+        try:
+            while not self._shutdown_request.done():
+                await asyncio.wait([self._shutdown_request], timeout=poll_interval)
+                self.service_actions()
+        finally:
+            self.transport.close()
+            self.transport = None
+
+    def shutdown(self):
+        """ Stops the serve_forever loop. Blocks until it has stopped."""
+        loop = self.loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._request_shutdown)
+        self._is_shut_down.wait()
+
+    def _request_shutdown(self):
+        if not self._shutdown_request.done():
+            self._shutdown_request.set_result(None)
+
+    def service_actions(self):
+        """Called by the server_forever() loop"""
+        pass
+
+    def sendto(self, address, data):
+        """Send data to specific address. Safe to call from any thread."""
+        if self._batch_or_count(address, data):
+            return
+        if self.transport is None:
+            self.socket.sendto(data, address)
+        elif threading.get_ident() == self._loop_thread:
+            self.transport.sendto(data, address)
+        else:
+            self.loop.call_soon_threadsafe(self._transport_sendto, data, address)
+
+    def _transport_sendto(self, data, address):
+        if self.transport is not None:
+            self.transport.sendto(data, address)
+
+    def _send_batch(self, items):
+        """ A whole batch costs one hop onto the event loop."""
+        if self.transport is None:
+            SendBatchMixIn._send_batch(self, items)
+        elif threading.get_ident() == self._loop_thread:
+            self._transport_send_batch(items)
+        else:
+            self.loop.call_soon_threadsafe(self._transport_send_batch, items)
+
+    def _transport_send_batch(self, items):
+        transport = self.transport
+        if transport is None:
+            return
+        for data, address in items:
+            transport.sendto(data, address)
+
+    def _schedule_coroutine(self, coro):
+        """ Async handlers run as tasks on the server's event loop."""
+        if threading.get_ident() == self._loop_thread:
+            self.loop.create_task(coro)
+        else:
+            asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def message_received(self, data, socket_address):
+        """ This is called when we receive data. Override this. """
+        pass
+
+
+class _ServerDatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        if self.server.capture is not None:
+            self.server.capture.inbound(addr, data, self.server.clock())
+        request = (data, self.server.socket)
+        if self.server.verify_request(request, addr):
+            self.server.finish_request(request, addr)
+
+    def error_received(self, exc):
+        # ICMP errors (e.g. port unreachable) from a client going away;
+        # the heartbeat system will take care of it.
+        pass
+
+
+class TimingWheel:
+    """ Hashed timing wheel for deadlines.
+
+        touch() is O(1). expire() only looks at the slots whose time has
+        come, so checking for timeouts doesn't cost anything for keys that
+        aren't due yet. A key whose deadline was pushed back since it was
+        placed is just moved to its new slot when its old slot comes up.
+    """
+    def __init__(self, resolution=0.25, slots=512):
+        self.resolution = resolution
+        self._slots = [set() for _ in range(slots)]
+        self._deadlines = {}
+        self._slot_of = {}
+        self._tick = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def _slot_for(self, deadline):
+        tick = int(math.ceil(deadline / self.resolution))
+        if self._tick is not None and tick <= self._tick:
+            # already in the past, check it on the next expire()
+            tick = self._tick + 1
+        return tick % len(self._slots)
+
+    def touch(self, key, deadline):
+        """ Sets the deadline for a key, adding it if needed. """
+        with self._lock:
+            if key in self._slot_of:
+                # it stays in its current slot, expire() reschedules it lazily
+                self._deadlines[key] = deadline
+                return
+            self._deadlines[key] = deadline
+            slot = self._slot_for(deadline)
+            self._slot_of[key] = slot
+            self._slots[slot].add(key)
+
+    def remove(self, key):
+        with self._lock:
+            if key not in self._deadlines:
+                return
+            del self._deadlines[key]
+            self._slots[self._slot_of.pop(key)].discard(key)
+
+    def expire(self, now):
+        """ Removes and returns every key whose deadline is <= now. """
+        now_tick = int(now // self.resolution)
+        expired = []
+        with self._lock:
+            first_tick = now_tick - len(self._slots) + 1
+            if self._tick is not None:
+                first_tick = max(self._tick + 1, first_tick)
+            self._tick = now_tick
+
+            for tick in range(first_tick, now_tick + 1):
+                slot = tick % len(self._slots)
+                due = self._slots[slot]
+                if not due:
+                    continue
+                self._slots[slot] = set()
+                for key in due:
+                    deadline = self._deadlines[key]
+                    if deadline <= now:
+                        del self._deadlines[key]
+                        del self._slot_of[key]
+                        expired.append(key)
+                    else:
+                        new_slot = self._slot_for(deadline)
+                        self._slot_of[key] = new_slot
+                        self._slots[new_slot].add(key)
+        return expired
+
+
+class ClientState:
+    """ Everything the server remembers about one client address. """
+    __slots__ = ('address', 'connected_at', 'last_seen', 'packets_in', 'packets_out', 'data')
+
+    def __init__(self, address, now):
+        self.address = address
+        self.connected_at = now
+        self.last_seen = now
+        self.packets_in = 0
+        self.packets_out = 0
+        # free for the application to use
+        self.data = None
+
+
+class ClientRegistry:
+    """ Connected clients, keyed by address.
+
+        Lookup, insert and removal are all constant time. Iterating gives
+        the addresses, like the plain list it replaces did.
+    """
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def __contains__(self, address):
+        return address in self._clients
+
+    def __iter__(self):
+        # snapshot, so handlers on other threads can connect/disconnect
+        # clients while we're looping
+        return iter(list(self._clients))
+
+    def get(self, address):
+        return self._clients.get(address)
+
+    def states(self):
+        return list(self._clients.values())
+
+    def connect(self, address, now):
+        """ Returns (ClientState, True if the client is new). """
+        client = self._clients.get(address)
+        if client is not None:
+            return client, False
+        with self._lock:
+            client = self._clients.get(address)
+            if client is not None:
+                return client, False
+            client = ClientState(address, now)
+            self._clients[address] = client
+            return client, True
+
+    def remove(self, address):
+        with self._lock:
+            return self._clients.pop(address, None)
+
+
+class PendingPacket:
+    """ A reliable packet that hasn't been acked yet. """
+    __slots__ = ('client', 'sequence', 'message', 'sent_at', 'deadline', 'retries')
+
+    def __init__(self, client, sequence, message, now, deadline):
+        self.client = client
+        self.sequence = sequence
+        # whatever the caller needs to send it again
+        self.message = message
+        self.sent_at = now
+        self.deadline = deadline
+        self.retries = 0
 
+
+class RoundTripEstimate:
+    """ Smoothed RTT and retransmit timeout for one client (RFC 6298). """
+    __slots__ = ('srtt', 'rttvar', 'rto')
+
+    def __init__(self, initial_rto):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+
+    def sample(self, rtt, min_rto, max_rto):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, min_rto), max_rto)
+
+
+class ReliableSender:
+    """ Keeps track of reliable packets until they are acked.
+
+        Pending packets are kept in a dict keyed by (client, sequence), so
+        an ack is O(1), and in a heap ordered by resend deadline, so due()
+        only looks at packets that are actually due. Timeouts adapt to the
+        measured round trip time of each client, back off exponentially and
+        give up after `max_retries` resends.
+
+        Not thread safe, callers hold their own lock.
+    """
+    def __init__(self, max_sequence=65536, initial_rto=1.0, min_rto=0.1, max_rto=4.0, max_retries=10):
+        self.max_sequence = max_sequence
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.max_retries = max_retries
+
+        # packets dropped after max_retries
+        self.gave_up = 0
+
+        self._pending = {}
+        self._by_client = {}
+        self._deadlines = []
+        self._rtt = {}
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def rto(self, client):
+        estimate = self._rtt.get(client)
+        return estimate.rto if estimate is not None else self.initial_rto
+
+    def add(self, client, sequence, message, now):
+        packet = PendingPacket(client, sequence, message, now, now + self.rto(client))
+        key = (client, sequence)
+        self._pending[key] = packet
+        self._by_client.setdefault(client, set()).add(sequence)
+        self._schedule(packet)
+        return packet
+
+    def _schedule(self, packet):
+        self._counter += 1
+        heapq.heappush(self._deadlines, (packet.deadline, self._counter, packet))
+
+    def ack(self, client, sequence, now):
+        """ Returns True if the packet was pending. """
+        packet = self._pending.pop((client, sequence), None)
+        if packet is None:
+            return False
+        self._by_client[client].discard(sequence)
+        if packet.retries == 0:
+            # only sample packets that weren't resent (Karn's algorithm)
+            estimate = self._rtt.get(client)
+            if estimate is None:
+                estimate = self._rtt[client] = RoundTripEstimate(self.initial_rto)
+            estimate.sample(now - packet.sent_at, self.min_rto, self.max_rto)
+        return True
+
+    def ack_bits(self, client, last_sequence, bits, now):
+        """ Acks `last_sequence` and each of the 32 sequences before it
+            whose bit is set. Returns how many pending packets were acked.
+        """
+        acked = 1 if self.ack(client, last_sequence, now) else 0
+        while bits:
+            low = bits & -bits
+            sequence = (last_sequence - low.bit_length()) % self.max_sequence
+            if self.ack(client, sequence, now):
+                acked += 1
+            bits ^= low
+        return acked
+
+    def due(self, now):
+        """ Returns the packets that need to be sent again, and schedules
+            their next resend.
+        """
+        resend = []
+        deadlines = self._deadlines
+        while deadlines and deadlines[0][0] <= now:
+            deadline, _, packet = heapq.heappop(deadlines)
+            key = (packet.client, packet.sequence)
+            if self._pending.get(key) is not packet or packet.deadline != deadline:
+                # acked or forgotten since it was scheduled
+                continue
+            if packet.retries >= self.max_retries:
+                del self._pending[key]
+                self._by_client[packet.client].discard(packet.sequence)
+                self.gave_up += 1
+                continue
+            packet.retries += 1
+            timeout = self.rto(packet.client) * (2 ** packet.retries)
+            packet.deadline = now + min(timeout, self.max_rto)
+            self._schedule(packet)
+            resend.append(packet)
+        return resend
+
+    def forget(self, client):
+        """ Drops everything pending for a client that went away. """
+        for sequence in self._by_client.pop(client, ()):
+            self._pending.pop((client, sequence), None)
+        self._rtt.pop(client, None)
+
+
+class ReceivedSequences:
+    """ Receiving side of ReliableSender.ack_bits(): remembers the newest
+        sequence number seen and which of the 32 before it arrived.
+    """
+    def __init__(self, max_sequence=65536):
+        self.max_sequence = max_sequence
+        self.last = None
+        self.bits = 0
+
+    def received(self, sequence):
+        if self.last is None:
+            self.last = sequence
+            return
+        ahead = (sequence - self.last) % self.max_sequence
+        if ahead == 0:
+            return
+        if ahead < self.max_sequence // 2:
+            # newer, shift the history along
+            if ahead <= 32:
+                self.bits = ((self.bits << ahead) | (1 << (ahead - 1))) & 0xFFFFFFFF
+            else:
+                self.bits = 0
+            self.last = sequence
+        else:
+            behind = self.max_sequence - ahead
+            if behind <= 32:
+                self.bits |= 1 << (behind - 1)
+
+    def ack_payload(self):
+        return [self.last, self.bits]
+
+
+class Inbox:
+    """ Commands handed from handler threads to one consumer thread.
+
+        put() never blocks or takes a lock (deque appends are atomic), so
+        network handlers never wait for the game loop. The consumer runs
+        everything queued so far with drain(), typically at the start of a
+        tick, and owns all the state the commands touch.
+    """
+    def __init__(self):
+        self._queue = collections.deque()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, command, *args):
+        self._queue.append((command, args))
+
+    def drain(self):
+        """ Runs the commands queued before it was called, in order.
+            Commands put() while draining wait for the next drain().
+            Returns how many ran.
+        """
+        queue = self._queue
+        count = len(queue)
+        for _ in range(count):
+            command, args = queue.popleft()
+            try:
+                command(*args)
+            except Exception:
+                # one bad command shouldn't take the consumer down
+                traceback.print_exc()
+        return count
+
+
+class TickScheduler:
+    """ Fixed timestep ticks on a monotonic clock.
+
+        Elapsed time goes into an accumulator and the callback is run once
+        for every whole step in it, with the fixed step as dt, so leftover
+        time carries over and the tick rate doesn't drift. When the
+        callback can't keep up, at most `max_catch_up` ticks are run per
+        poll and the rest are dropped (counted in dropped_ticks).
+        `on_overrun(duration)` is called for every tick that took longer
+        than a step.
+    """
+    def __init__(self, tick_rate, max_catch_up=5, spin=0.002, clock=time.perf_counter):
+        self.step = 1.0 / tick_rate
+        self.max_catch_up = max_catch_up
+        # run_forever() sleeps until this close to the next tick, then spins
+        self.spin = spin
+        self.clock = clock
+
+        self.on_overrun = None
+        self.ticks = 0
+        self.dropped_ticks = 0
+        self.last_tick_duration = 0
+
+        self._last = None
+        self._accumulator = 0
+        self._running = False
+
+    def poll(self, callback):
+        """ Runs every tick that is due, without waiting. Returns how many
+            ticks were run.
+        """
+        now = self.clock()
+        if self._last is None:
+            self._last = now
+        self._accumulator += now - self._last
+        self._last = now
+
+        ran = 0
+        while self._accumulator >= self.step and ran < self.max_catch_up:
+            start = self.clock()
+            callback(self.step)
+            self.last_tick_duration = self.clock() - start
+            self._accumulator -= self.step
+            self.ticks += 1
+            ran += 1
+            if self.last_tick_duration > self.step and self.on_overrun is not None:
+                self.on_overrun(self.last_tick_duration)
+
+        if self._accumulator >= self.step:
+            # too far behind to catch up, drop the rest
+            dropped = int(self._accumulator / self.step)
+            self.dropped_ticks += dropped
+            self._accumulator -= dropped * self.step
+        return ran
+
+    def time_until_next(self):
+        return self.step - self._accumulator - (self.clock() - self._last)
+
+    def run_forever(self, callback):
+        """ Runs ticks until stop() is called. """
+        self._running = True
+        while self._running:
+            self.poll(callback)
+            remaining = self.time_until_next()
+            if remaining > self.spin:
+                time.sleep(remaining - self.spin)
+            while self._running and self.time_until_next() > 0:
+                pass
+
+    def stop(self):
+        self._running = False
+
+
+class EventMixin:
+    """ EventMixin
+
+        Adds an "event message" system, as well as a heartbeat system
+        (automatically considers endpoints "disconnected" if they haven't
+        talked to us in a while) to a UDP server class.
+    """
+    # integer events at or above this go in the dict, not the table
+    max_table_event = 4096
+
+    # split messages bigger than max_datagram_size into fragments.
+    # Fragments are always put back together on receive.
+    fragment = False
+
+    def __init__(self):
         # remember connected clients
-        self.clients = []
+        self.clients = ClientRegistry()
 
         # heartbeat rate
         # call clients "dead" if we haven't received anything from them in
         # this amount of time.
         self.heartbeat_rate = 30 # seconds
-        self._heartbeats = {}
-        self._last_time = time.time()
+        self._heartbeats = TimingWheel()
+        self._heartbeat_ticks = TickScheduler(1.0 / self._heartbeats.resolution, max_catch_up=1,
+                                              clock=lambda: self.clock())
 
-        # event handlers
+        # event handlers, as registered
         self.handlers = {}
+        # wrap every handler, see use()
+        self._middleware = []
+        # what _trigger() calls: (handler with middleware, timer) per event.
+        # Integer events (including IntEnums) are looked up by index in a
+        # flat list, everything else in a dict.
+        self._dispatch_table = []
+        self._dispatch = {}
+        self.metrics.gauge('clients', 'Connected clients', function=lambda: len(self.clients))
+
+        self._fragmenter = Fragmenter()
+        self._reassembler = Reassembler()
+        self.metrics.gauge('fragments_pending', 'Reliable fragmented messages waiting for acks',
+                           function=lambda: len(self._fragmenter))
+        self.metrics.gauge('reassembly_dropped', 'Fragmented messages dropped before they were complete',
+                           function=lambda: self._reassembler.dropped)
 
         # In order to call events based on message types, we need a protocol.
         # This protocol needs to be followed by the server and the clients.
@@ -74,34 +1691,35 @@ class EventServer(ThreadedUDPServer):
 
     def service_actions(self):
         """Called by the server_forever() loop"""
-        time_now = time.time()
-        delta = time_now - self._last_time
-        self._last_time = time_now
+        # serve_forever() calls this after every request; only check
+        # heartbeats at a fixed rate
+        self._heartbeat_ticks.poll(self._check_heartbeats)
 
+    def _check_heartbeats(self, dt):
         # check heartbeats if > 0.
-        dead_clients = []
+        # only clients whose deadline has passed are looked at
         if self.heartbeat_rate > 0:
-            for client in self._heartbeats:
-                heart = self._heartbeats[client]
-                heart += delta
-                if heart > self.heartbeat_rate:
-                    # consider this client disconnected
-                    # TODO: have a "staging" disconnect state
-                    # print("removing dead client: {}".format(client))
-                    dead_clients.append(client)
-                else:
-                    self._heartbeats[client] = heart
-
-        for client in dead_clients:
-            # remove from client list
-            del self._heartbeats[client]
-            self.clients.remove(client)
-            # trigger disconnect event
-            self._trigger('disconnected', None, client)
+            for client in self._heartbeats.expire(self.clock()):
+                # consider this client disconnected
+                # TODO: have a "staging" disconnect state
+                self.clients.remove(client)
+                self.forget_address(client)
+                # trigger disconnect event
+                self._trigger('disconnected', None, client)
 
     def _trigger(self, event, data, addr):
-        if event in self.handlers:
-            self.handlers[event](data, addr)
+        table = self._dispatch_table
+        if isinstance(event, int) and 0 <= event < len(table):
+            entry = table[event]
+        else:
+            entry = self._dispatch.get(event)
+        if entry is not None:
+            handler, timer = entry
+            start = time.perf_counter()
+            result = handler(data, addr)
+            timer.record(time.perf_counter() - start)
+            if asyncio.iscoroutine(result):
+                self._schedule_coroutine(result)
         elif self.debug_message_unhandled:
             print("Unhandled event [{}]. Payload: {}".format(event, data))
 
@@ -109,32 +1727,147 @@ class EventServer(ThreadedUDPServer):
         """ Used to register a function/method to handle a particular message """
         def set_handler(handler):
             self.handlers[event] = handler
+            self._compile(event)
             return handler
 
         if handler is None:
             return set_handler
         set_handler(handler)
 
+    def use(self, middleware):
+        """ Adds middleware around every handler. `middleware(event, handler)`
+            is called once per event, when handlers are registered, and
+            returns the handler to call instead (or the same one, to skip
+            events it doesn't care about). The first one added is outermost.
+        """
+        self._middleware.append(middleware)
+        for event in self.handlers:
+            self._compile(event)
+        return middleware
+
+    def _compile(self, event):
+        handler = self.handlers[event]
+        for middleware in reversed(self._middleware):
+            handler = middleware(event, handler)
+        timer = self.metrics.histogram(
+            'handler_seconds', 'Time spent in event handlers', event=getattr(event, 'name', event))
+        entry = (handler, timer)
+
+        # small non-negative integers index straight into the table
+        if isinstance(event, int) and 0 <= event < self.max_table_event:
+            table = self._dispatch_table
+            if event >= len(table):
+                table.extend([None] * (event + 1 - len(table)))
+            table[event] = entry
+        else:
+            self._dispatch[event] = entry
+
     def send(self, client, event, payload):
         """Send message to specific client"""
-        msg = self._message_protocol.create(event, payload)
-        if self.debug_message_size:
-            print("[SOCKET OUTGOING SIZE] {}".format(sys.getsizeof(msg)))
-        super(EventServer, self).sendto(client, msg)
+        self._send_message(client, self._message_protocol.create(event, payload))
 
     def send_all(self, event, payload):
-        """ Send message to all connected clients. """
+        """ Send message to all connected clients. The message is only
+            encoded once.
+        """
+        msg = self._message_protocol.create(event, payload)
         for client in self.clients:
-            self.send(client, event, payload)
+            self._send_message(client, msg)
+
+    def sendto(self, address, data, reliable=False):
+        """ Send data to specific address. With `fragment` on, data too big
+            for one datagram is sent as fragments. If it's `reliable`, the
+            receiver acks every fragment, and sending the same data again
+            only resends the fragments that weren't acked.
+        """
+        if self.fragment and len(data) > self.max_datagram_size:
+            for datagram in self._fragmenter.split(address, data, self.max_datagram_size, reliable, self.clock()):
+                super().sendto(address, datagram)
+            return
+        super().sendto(address, data)
+
+    def forget_address(self, address):
+        super().forget_address(address)
+        self._fragmenter.forget(address)
+
+    def _fragment_received(self, data, socket_address, now):
+        """ Returns the whole message once its last fragment arrives. """
+        if is_fragment_ack(data):
+            self._fragmenter.acked(socket_address, data)
+            return None
+        message, ack = self._reassembler.add(socket_address, data, now)
+        if ack is not None:
+            super().sendto(socket_address, ack)
+        return message
+
+    def _send_message(self, client, msg):
+        if self.debug_message_size:
+            print("[SOCKET OUTGOING SIZE] {}".format(len(msg)))
+        state = self.clients.get(client)
+        if state is not None:
+            state.packets_out += 1
+        self.sendto(client, msg)
 
     def message_received(self, data, socket_address):
-        if socket_address not in self.clients:            
-            self.clients.append(socket_address)
-            self._heartbeats[socket_address] = 0            
+        now = self.clock()
+        client, is_new = self.clients.connect(socket_address, now)
+        client.last_seen = now
+        client.packets_in += 1
+        self._heartbeats.touch(socket_address, now + self.heartbeat_rate)
+        if is_new:
             self._trigger('connected', None, socket_address)
-        else:
-            self._heartbeats[socket_address] = 0
-        message = self._message_protocol.parse(data)
-        message_type = message[0]
-        payload = message[3]
-        self._trigger(message_type, payload, socket_address)
+        for data in split_datagram(data):
+            if data and data[0] == FRAGMENT:
+                data = self._fragment_received(data, socket_address, now)
+                if data is None:
+                    continue
+            message = self._message_protocol.parse(data)
+            message_type = message[0]
+            payload = message[3]
+            self._trigger(message_type, payload, socket_address)
+
+
+class EventServer(EventMixin, ThreadedUDPServer):
+    """ EventServer
+
+        Builds off of the ThreadedUDPServer to add the event and heartbeat
+        systems. Every datagram is handled on its own thread.
+    """
+    def __init__(self, server_address, bind_and_activate=True, transport=None):
+        ThreadedUDPServer.__init__(self, server_address, bind_and_activate, transport)
+        EventMixin.__init__(self)
+
+
+class AsyncEventServer(EventMixin, AsyncUDPServer):
+    """ AsyncEventServer
+
+        Drop-in replacement for the EventServer that handles every datagram
+        on a single asyncio event loop. Handlers may be plain functions or
+        coroutine functions.
+    """
+    def __init__(self, server_address, bind_and_activate=True):
+        AsyncUDPServer.__init__(self, server_address, bind_and_activate)
+        EventMixin.__init__(self)
+
+
+class BatchedEventServer(EventMixin, BatchUDPServer):
+    """ BatchedEventServer
+
+        EventServer on top of the BatchUDPServer: datagrams are drained in
+        bulk and handled on the serve_forever() thread.
+    """
+    def __init__(self, server_address, bind_and_activate=True, batch_size=64, transport=None):
+        BatchUDPServer.__init__(self, server_address, bind_and_activate, batch_size, transport)
+        EventMixin.__init__(self)
+
+
+class PooledEventServer(EventMixin, PooledUDPServer):
+    """ PooledEventServer
+
+        EventServer on top of the PooledUDPServer: handlers run on a fixed
+        pool of workers, in order per client.
+    """
+    def __init__(self, server_address, bind_and_activate=True, workers=None, queue_size=None, overload_policy=None,
+                 transport=None):
+        PooledUDPServer.__init__(self, server_address, bind_and_activate, workers, queue_size, overload_policy, transport)
+        EventMixin.__init__(self)
@@ -0,0 +1,123 @@
+# Multi-process sharding
+#
+# Runs N copies of an EventServer in separate processes, all bound to the
+# same port with SO_REUSEPORT. The kernel hashes each client address to one
+# of the sockets, so a client always talks to the same worker.
+#
+import multiprocessing
+import queue
+import socket
+import threading
+from server import EventServer
+
+
+class Shard:
+    """ Handle given to the setup function of every worker process.
+
+        Lets a worker broadcast to the clients of every other worker and
+        see how many clients are connected across all workers.
+    """
+    def __init__(self, index, server, inboxes, client_counts):
+        self.index = index
+        self.server = server
+        self._inboxes = inboxes
+        self._client_counts = client_counts
+
+    def broadcast(self, event, payload):
+        """ send_all() on every worker, including this one. """
+        self.server.send_all(event, payload)
+        for i, inbox in enumerate(self._inboxes):
+            if i != self.index:
+                inbox.put((event, payload))
+
+    def total_clients(self):
+        return sum(self._client_counts)
+
+    def _relay(self, update_interval):
+        """ Worker thread: pushes broadcasts from other workers to our
+            clients and publishes our client count.
+        """
+        inbox = self._inboxes[self.index]
+        while True:
+            try:
+                message = inbox.get(timeout=update_interval)
+            except queue.Empty:
+                message = None
+            self._client_counts[self.index] = len(self.server.clients)
+            if message is not None:
+                event, payload = message
+                self.server.send_all(event, payload)
+
+
+def _run_shard(index, server_class, server_address, setup, inboxes, client_counts, update_interval):
+    server = server_class(server_address, bind_and_activate=False)
+    server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.server_bind()
+
+    shard = Shard(index, server, inboxes, client_counts)
+    if setup is not None:
+        setup(server, shard)
+
+    relay = threading.Thread(target=shard._relay, args=[update_interval])
+    relay.daemon = True
+    relay.start()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class ShardedServer:
+    """ ShardedServer
+
+        Starts `workers` processes, each running its own `server_class`
+        bound to `server_address`. `setup(server, shard)` is called in every
+        worker to register handlers; it has to be picklable (a module level
+        function) on platforms that spawn instead of fork.
+    """
+    def __init__(self, server_address, setup, workers=None, server_class=EventServer):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+
+        self.server_address = server_address
+        self.setup = setup
+        self.workers = workers or multiprocessing.cpu_count()
+        self.server_class = server_class
+
+        # how often workers publish their client count
+        self.update_interval = 0.5
+
+        self._inboxes = [multiprocessing.Queue() for _ in range(self.workers)]
+        self._client_counts = multiprocessing.Array('i', self.workers)
+        self._processes = []
+
+    def start(self):
+        for i in range(self.workers):
+            process = multiprocessing.Process(
+                target=_run_shard,
+                args=[i, self.server_class, self.server_address, self.setup,
+                      self._inboxes, self._client_counts, self.update_interval])
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+    def broadcast(self, event, payload):
+        """ send_all() on every worker. """
+        for inbox in self._inboxes:
+            inbox.put((event, payload))
+
+    def total_clients(self):
+        return sum(self._client_counts)
+
+    def join(self):
+        for process in self._processes:
+            process.join()
+
+    def stop(self):
+        for process in self._processes:
+            process.terminate()
+        self.join()
+        self._processes.clear()
@@ -0,0 +1,184 @@
+# simulate.py
+#
+# Runs the example game with thousands of simulated players in one process,
+# on a loopback network instead of UDP. The network, the players and the
+# game all run on virtual time from one seed, so a run with the same options
+# plays out the same every time (the digest printed at the end shows it),
+# and what's measured is only the server's own work.
+#
+# Game options it doesn't know are passed on to the game.
+#
+# Example:
+#   python simulate.py --clients 1000 --duration 5
+#   python simulate.py --clients 500 --latency 0.05 --jitter 0.02 --loss 0.05 -- --coalesce
+#
+import argparse
+import cProfile
+import pstats
+import random
+import time
+import zlib
+from example_game_server import GameServer, PacketProtocol, PacketId, PlayerClient, MAX_SEQUENCE_NUMBER
+import example_game_server
+from loopback import LoopbackNetwork
+from replication import SnapshotReceiver
+from server import EventServer, Histogram, ReceivedSequences, Reassembler, split_datagram, FRAGMENT
+
+ARGS = argparse.ArgumentParser(description="Simulate players on a loopback network")
+ARGS.add_argument('--clients', action="store", dest="clients", default="1000", help="How many players to simulate.")
+ARGS.add_argument('--duration', action="store", dest="duration", default="10", help="Seconds of game time to simulate.")
+ARGS.add_argument('--inputRate', action="store", dest="inputRate", default="0", help="Stamped inputs each player sends per second. 0 is one per game tick.")
+ARGS.add_argument('--latency', action="store", dest="latency", default="0", help="One way latency, in seconds.")
+ARGS.add_argument('--jitter', action="store", dest="jitter", default="0", help="Up to this many seconds added to the latency.")
+ARGS.add_argument('--loss', action="store", dest="loss", default="0", help="Chance of a datagram being lost.")
+ARGS.add_argument('--duplicate', action="store", dest="duplicate", default="0", help="Chance of a datagram arriving twice.")
+ARGS.add_argument('--reorder', action="store", dest="reorder", default="0", help="Chance of a datagram arriving late, after later ones.")
+ARGS.add_argument('--seed', action="store", dest="seed", default="1", help="Seed for the network, the players and the game.")
+ARGS.add_argument('--profile', action="store_true", dest="profile", help="Profile the server and print the top functions.")
+
+
+class SimulatedClient:
+    """ A fake_client.py player that is run by simulate() instead of its
+        own thread and socket.
+    """
+    def __init__(self, sock, server_address, rng, input_rate=60):
+        self.sock = sock
+        self.server_address = server_address
+        self.random = rng
+        self.protocol = PacketProtocol()
+        self.input_rate = input_rate
+
+        self.player = None
+        self.join_timer = 0
+        self.movement = [0, 0]
+        self.movement_timer = 0
+        self.input_timer = 0
+        self.input_sequence = 0
+        self.input_tick = 0
+        self.recent_inputs = []
+
+        self.snapshots = SnapshotReceiver(PlayerClient.SNAPSHOT_FIELDS)
+        self.received = ReceivedSequences(MAX_SEQUENCE_NUMBER + 1)
+        self.reassembler = Reassembler()
+        self.digest = 0
+
+    def send(self, event, payload):
+        self.sock.sendto(self.protocol.create(event, payload, 0), self.server_address)
+
+    def join(self):
+        self.join_timer = 1
+        self.send(PacketId.JOIN, "hello, world")
+
+    def update(self, dt):
+        if self.player is None:
+            # the JOIN may have been lost
+            self.join_timer -= dt
+            if self.join_timer < 0:
+                self.join()
+            return
+        self.movement_timer -= dt
+        if self.movement_timer < 0:
+            self.movement = [self.random.randrange(-1, 2), self.random.randrange(-1, 2)]
+            self.movement_timer = 1
+        self.input_timer -= dt
+        if self.input_timer < 0:
+            self.input_timer += 1.0 / self.input_rate
+            self.input_sequence = (self.input_sequence + 1) % (MAX_SEQUENCE_NUMBER + 1)
+            self.input_tick += 1
+            self.recent_inputs.append([self.input_sequence, self.input_tick, self.movement[0], self.movement[1]])
+            del self.recent_inputs[:-3]
+            self.send(PacketId.PLAYER_INPUT, self.protocol.pack_data(self.recent_inputs))
+
+    def receive(self, now):
+        protocol = self.protocol
+        while True:
+            try:
+                datagram, address = self.sock.recvfrom(65536)
+            except BlockingIOError:
+                return
+            self.digest = zlib.crc32(datagram, self.digest)
+            for message in split_datagram(datagram):
+                if message and message[0] == FRAGMENT:
+                    message, ack = self.reassembler.add(address, message, now)
+                    if ack:
+                        self.sock.sendto(ack, self.server_address)
+                if not message:
+                    continue
+                message_type, sequence_number, needs_ack, payload = protocol.parse(message)
+                if message_type == PacketId.WELCOME:
+                    self.player = protocol.unpack_data(payload)
+                elif message_type == PacketId.SNAPSHOT:
+                    snapshot = self.snapshots.apply(protocol.unpack_data(payload))
+                    if snapshot:
+                        self.send(PacketId.SNAPSHOT_ACK, protocol.pack_data(snapshot[0]))
+                if needs_ack == 1:
+                    self.received.received(sequence_number)
+                    self.send(PacketId.ACK_BITS, protocol.pack_data(self.received.ack_payload()))
+
+
+def simulate(args, game_args):
+    seed = int(args.seed)
+    network = LoopbackNetwork(float(args.latency), float(args.jitter), float(args.loss),
+                              float(args.duplicate), float(args.reorder), seed=seed)
+    # the game's own randomness, like where players spawn
+    random.seed(seed)
+
+    game = GameServer(example_game_server.ARGS.parse_args(game_args))
+    server_address = ("127.0.0.1", game._server_address[1])
+    server = EventServer(server_address, transport=network.socket(server_address))
+    server.clock = network.clock
+    game.attach(server)
+
+    input_rate = float(args.inputRate) or game._tick_rate
+    rng = random.Random(seed)
+    clients = [SimulatedClient(network.socket(), server_address, random.Random(rng.random()), input_rate)
+               for _ in range(int(args.clients))]
+    for client in clients:
+        client.join()
+
+    step = 1.0 / game._tick_rate
+    server_seconds = Histogram()
+    profiler = cProfile.Profile() if args.profile else None
+    start_wall = time.perf_counter()
+    for _ in range(int(float(args.duration) * game._tick_rate)):
+        network.advance(step)
+
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        server.handle_pending()
+        game.tick(step)
+        server.service_actions()
+        if profiler is not None:
+            profiler.disable()
+        server_seconds.record(time.perf_counter() - start)
+
+        for client in clients:
+            client.receive(network.now)
+            client.update(step)
+    wall = time.perf_counter() - start_wall
+
+    digest = 0
+    for client in clients:
+        digest = zlib.crc32(client.digest.to_bytes(4, 'big'), digest)
+    metrics = server.metrics.snapshot()
+    joined = sum(1 for client in clients if client.player is not None)
+
+    print("{} players ({} joined), {:.0f}s of game time in {:.1f}s".format(len(clients), joined, network.now, wall))
+    print("  server per tick: p50 {:.3f}ms  p99 {:.3f}ms  max {:.3f}ms  ({:.1f}ms budget)".format(
+        server_seconds.percentile(0.5) * 1000, server_seconds.percentile(0.99) * 1000,
+        server_seconds.max * 1000, step * 1000))
+    print("  server: {} datagrams in, {} out, {} bytes out".format(
+        metrics['packets_in'], metrics['packets_out'], metrics['bytes_out']))
+    print("  network: {} sent, {} delivered, {} lost, {} duplicated, {} reordered".format(
+        network.sent, network.delivered, network.lost, network.duplicated, network.reordered))
+    print("  digest {:08x}".format(digest))
+
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+
+if __name__ == '__main__':
+    # anything we don't know is a game server option
+    args, game_args = ARGS.parse_known_args()
+    simulate(args, [arg for arg in game_args if arg != '--'])
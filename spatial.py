@@ -0,0 +1,79 @@
+# Spatial hash grid
+#
+# Buckets entities into square cells of `cell_size` world units so "what is
+# near this point" only has to look at the few cells around it instead of
+# every entity in the world.
+#
+import math
+
+
+class SpatialHashGrid:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        # (cell x, cell y) -> set of entity ids
+        self._cells = {}
+        # entity id -> (x, y, cell)
+        self._entities = {}
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __contains__(self, entity_id):
+        return entity_id in self._entities
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def move(self, entity_id, x, y):
+        """ Inserts the entity or updates its position. Only touches the
+            cell buckets when the entity actually changed cells.
+        """
+        cell = self._cell(x, y)
+        entry = self._entities.get(entity_id)
+        if entry is not None and entry[2] != cell:
+            bucket = self._cells[entry[2]]
+            bucket.discard(entity_id)
+            if not bucket:
+                del self._cells[entry[2]]
+        if entry is None or entry[2] != cell:
+            self._cells.setdefault(cell, set()).add(entity_id)
+        self._entities[entity_id] = (x, y, cell)
+
+    def remove(self, entity_id):
+        entry = self._entities.pop(entity_id, None)
+        if entry is None:
+            return
+        bucket = self._cells[entry[2]]
+        bucket.discard(entity_id)
+        if not bucket:
+            del self._cells[entry[2]]
+
+    def position(self, entity_id):
+        entry = self._entities[entity_id]
+        return entry[0], entry[1]
+
+    def query(self, x, y, radius):
+        """ Ids of every entity within `radius` of (x, y). """
+        min_x, min_y = self._cell(x - radius, y - radius)
+        max_x, max_y = self._cell(x + radius, y + radius)
+        radius_sq = radius * radius
+        cells = self._cells
+        entities = self._entities
+        found = []
+        for cx in range(min_x, max_x + 1):
+            for cy in range(min_y, max_y + 1):
+                bucket = cells.get((cx, cy))
+                if not bucket:
+                    continue
+                for entity_id in bucket:
+                    ex, ey, _ = entities[entity_id]
+                    dx = ex - x
+                    dy = ey - y
+                    if dx * dx + dy * dy <= radius_sq:
+                        found.append(entity_id)
+        return found
+
+    def neighbors(self, entity_id, radius):
+        """ Everything within `radius` of an entity, not including itself. """
+        x, y = self.position(entity_id)
+        return [other for other in self.query(x, y, radius) if other != entity_id]
@@ -0,0 +1,40 @@
+# Tests for packing messages into datagrams (coalesce and split_datagram).
+#
+#   python -m pytest test_coalesce.py
+#
+from server import coalesce, split_datagram, COALESCED
+
+A = ("127.0.0.1", 9000)
+B = ("127.0.0.1", 9001)
+
+
+def received(out, address):
+    return [message for data, to in out if to == address for message in split_datagram(data)]
+
+
+def test_messages_to_one_address_share_a_datagram():
+    out = coalesce([(b'one', A), (b'two', B), (b'three', A)], 1200)
+    assert len(out) == 2
+    assert received(out, A) == [b'one', b'three']
+    # alone, it goes as it is
+    assert (b'two', B) in out
+
+
+def test_datagrams_stay_under_the_size():
+    items = [(bytes([i]) * 100, A) for i in range(50)]
+    out = coalesce(items, 1200)
+    assert all(len(data) <= 1200 and data[0] == COALESCED for data, _ in out)
+    assert received(out, A) == [data for data, _ in items]
+
+
+def test_oversized_messages_keep_their_place():
+    big = b'x' * 2000
+    out = coalesce([(b'a', A), (b'b', A), (big, A), (b'c', A), (b'd', B)], 1200)
+    assert (big, A) in out
+    assert received(out, A) == [b'a', b'b', big, b'c']
+    assert received(out, B) == [b'd']
+
+
+def test_split_leaves_plain_datagrams_alone():
+    assert split_datagram(b'plain') == [b'plain']
+    assert split_datagram(b'') == [b'']
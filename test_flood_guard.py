@@ -0,0 +1,77 @@
+# Tests for flood protection: TokenBucketLimiter and CookieHandshake.
+#
+#   python -m pytest test_flood_guard.py
+#
+from server import TokenBucketLimiter, CookieHandshake, handshake_reply, HANDSHAKE
+
+ADDRESS = ("127.0.0.1", 9000)
+HELLO = bytes((HANDSHAKE, 0)) + bytes(CookieHandshake.COOKIE_SIZE)
+ACCEPTED = bytes((HANDSHAKE, 3))
+
+
+def admit(handshake, address, now):
+    challenge = handshake.handle(HELLO, address, now)
+    return handshake.handle(handshake_reply(challenge), address, now)
+
+
+def test_limiter_allows_a_burst_then_the_rate():
+    limiter = TokenBucketLimiter(rate=10, burst=5)
+    assert [limiter.allow(ADDRESS, 0.0) for _ in range(6)] == [True] * 5 + [False]
+    # a tenth of a second buys one more
+    assert limiter.allow(ADDRESS, 0.1)
+    assert not limiter.allow(ADDRESS, 0.1)
+    # other addresses have their own bucket
+    assert limiter.allow(("127.0.0.1", 9001), 0.1)
+
+
+def test_limiter_drops_new_addresses_when_full():
+    limiter = TokenBucketLimiter(rate=10, burst=5, max_addresses=2)
+    for port in range(2):
+        for _ in range(5):
+            limiter.allow(("127.0.0.1", port), 0.0)
+    assert not limiter.allow(("127.0.0.1", 2), 0.0)
+    # once the buckets have filled back up they're forgotten
+    assert limiter.allow(("127.0.0.1", 2), 1.0)
+    assert len(limiter) == 1
+
+
+def test_handshake_admits_only_with_the_cookie():
+    handshake = CookieHandshake()
+    challenge = handshake.handle(HELLO, ADDRESS, 0.0)
+    assert len(challenge) == len(HELLO)
+    assert not handshake.is_admitted(ADDRESS, 0.0)
+    # the cookie is bound to the address
+    assert handshake.handle(handshake_reply(challenge), ("127.0.0.1", 9001), 0.0) != ACCEPTED
+    assert handshake.handle(handshake_reply(challenge), ADDRESS, 0.0) == ACCEPTED
+    assert handshake.is_admitted(ADDRESS, 0.0)
+
+
+def test_handshake_never_amplifies():
+    handshake = CookieHandshake()
+    assert handshake.handle(b'\x00', ADDRESS, 0.0) is None
+    assert handshake.handle(HELLO[:-1], ADDRESS, 0.0) is None
+
+
+def test_cookies_expire():
+    handshake = CookieHandshake(lifetime=10.0)
+    challenge = handshake.handle(HELLO, ADDRESS, 0.0)
+    assert handshake.handle(handshake_reply(challenge), ADDRESS, 25.0) != ACCEPTED
+
+
+def test_quiet_addresses_have_to_handshake_again():
+    handshake = CookieHandshake(idle_timeout=30.0)
+    assert admit(handshake, ADDRESS, 0.0) == ACCEPTED
+    assert handshake.is_admitted(ADDRESS, 20.0)
+    assert handshake.is_admitted(ADDRESS, 45.0)
+    assert not handshake.is_admitted(ADDRESS, 80.0)
+    assert len(handshake) == 0
+
+
+def test_admitted_addresses_are_capped():
+    handshake = CookieHandshake(max_admitted=2)
+    for port in range(3):
+        assert admit(handshake, ("127.0.0.1", port), float(port)) == ACCEPTED
+    assert len(handshake) == 2
+    # the quietest one went
+    assert not handshake.is_admitted(("127.0.0.1", 0), 3.0)
+    assert handshake.is_admitted(("127.0.0.1", 2), 3.0)
@@ -0,0 +1,93 @@
+# Tests for message fragmentation (Fragmenter and Reassembler).
+#
+#   python -m pytest test_fragmentation.py
+#
+import struct
+from server import Fragmenter, Reassembler, is_fragment_ack, FRAGMENT, MAX_FRAGMENTS
+
+ADDRESS = ("127.0.0.1", 9000)
+
+
+def test_steady_rate_reassembly():
+    """ A big message every tick must keep getting through, well past
+        max_per_address messages per timeout.
+    """
+    fragmenter = Fragmenter()
+    reassembler = Reassembler()
+    delivered = 0
+    for tick in range(600):
+        now = tick / 60
+        data = bytes([tick % 256]) * 3000
+        for datagram in fragmenter.split(ADDRESS, data, 1200, reliable=True, now=now):
+            message, ack = reassembler.add(ADDRESS, datagram, now)
+            if ack is not None:
+                fragmenter.acked(ADDRESS, ack)
+            if message is not None:
+                assert message == data
+                delivered += 1
+    assert delivered == 600
+    assert reassembler.dropped == 0
+    assert len(reassembler) == 0
+    assert len(fragmenter) == 0
+
+
+def test_message_ids_are_per_address():
+    """ Sending to other addresses doesn't use up one address's ids, so
+        they don't wrap around inside the duplicate window.
+    """
+    fragmenter = Fragmenter()
+    reassembler = Reassembler()
+    delivered = 0
+    for tick in range(300):
+        now = tick / 60
+        for port in range(300):
+            fragmenter.split(("10.0.0.1", port), b'x' * 3000, 1200, now=now)
+        for datagram in fragmenter.split(ADDRESS, b'y' * 3000, 1200, now=now):
+            message, _ = reassembler.add(ADDRESS, datagram, now)
+            delivered += message is not None
+    assert delivered == 300
+
+
+def test_resent_fragment_is_acked_but_not_delivered_twice():
+    fragmenter = Fragmenter()
+    reassembler = Reassembler()
+    datagrams = fragmenter.split(ADDRESS, b'z' * 3000, 1200, reliable=True)
+    results = [reassembler.add(ADDRESS, datagram, 0.0) for datagram in datagrams]
+    assert [message is not None for message, _ in results] == [False, False, True]
+
+    message, ack = reassembler.add(ADDRESS, datagrams[0], 1.0)
+    assert message is None
+    assert is_fragment_ack(ack)
+    fragmenter.acked(ADDRESS, ack)
+    assert len(fragmenter) == 0
+
+
+def test_dropped_counts_messages():
+    reassembler = Reassembler(max_per_address=2)
+    fragmenter = Fragmenter()
+    # the first fragment of 5 messages: starting the 3rd, 4th and 5th each
+    # drop the oldest one in progress
+    for _ in range(5):
+        reassembler.add(ADDRESS, fragmenter.split(ADDRESS, b'x' * 3000, 1200)[0], 0.0)
+    assert reassembler.dropped == 3
+    assert len(reassembler) == 2
+    # and the two left time out
+    reassembler.add(("10.0.0.2", 1), fragmenter.split(ADDRESS, b'x' * 3000, 1200)[0], 10.0)
+    assert reassembler.dropped == 5
+
+
+def test_fragment_floods_stay_bounded():
+    reassembler = Reassembler()
+    header = struct.Struct(">BBHBB")
+    # empty fragments are ignored outright
+    for port in range(1000):
+        reassembler.add(("10.0.0.1", port), header.pack(FRAGMENT, 0, 0, 0, MAX_FRAGMENTS), 0.0)
+    assert len(reassembler) == 0
+    # one byte fragments of 64 fragment messages, each from its own address:
+    # the overhead of every message in progress counts against max_bytes
+    for port in range(100000):
+        address = ("10.{}.{}.{}".format(port >> 16, port >> 8 & 255, port & 255), 9000)
+        reassembler.add(address, header.pack(FRAGMENT, 0, 0, 0, MAX_FRAGMENTS) + b'x', 0.0)
+    assert len(reassembler) <= reassembler.max_partials
+    assert reassembler._bytes <= reassembler.max_bytes
+    assert reassembler.dropped == 100000 - len(reassembler)
@@ -0,0 +1,70 @@
+# Tests for the game's per-player jitter buffer (InputBuffer).
+#
+#   python -m pytest test_input_buffer.py
+#
+from example_game_server import InputBuffer, MAX_SEQUENCE_NUMBER
+
+
+def test_waits_for_delay_inputs_then_one_per_tick():
+    buffer = InputBuffer(delay=2)
+    buffer.add(1, 1, [1, 0])
+    assert buffer.next() is None
+    buffer.add(2, 2, [0, 1])
+    assert buffer.next() == [1, 0]
+    assert buffer.next() == [0, 1]
+    assert buffer.last_sequence == 2
+    assert buffer.last_tick == 2
+
+
+def test_duplicates_and_stale_inputs_are_dropped():
+    buffer = InputBuffer(delay=1)
+    # sent out of order and more than once
+    assert buffer.add(2, 2, [0, 1])
+    assert buffer.add(1, 1, [1, 0])
+    assert not buffer.add(2, 2, [0, 1])
+    assert buffer.next() == [1, 0]
+    assert buffer.next() == [0, 1]
+    assert not buffer.add(1, 1, [1, 0])
+    assert buffer.stale == 1
+
+
+def test_one_late_input_does_not_rebuffer():
+    buffer = InputBuffer(delay=2)
+    for sequence in (1, 2):
+        buffer.add(sequence, sequence, [sequence, 0])
+    assert buffer.next() == [1, 0]
+    assert buffer.next() == [2, 0]
+    # one dry tick, then the late input comes straight out
+    assert buffer.next() is None
+    buffer.add(3, 3, [3, 0])
+    assert buffer.next() == [3, 0]
+    assert buffer.starved == 1
+    # `delay` dry ticks in a row and it waits for `delay` inputs again
+    assert buffer.next() is None
+    assert buffer.next() is None
+    buffer.add(4, 4, [4, 0])
+    assert buffer.next() is None
+    buffer.add(5, 5, [5, 0])
+    assert buffer.next() == [4, 0]
+
+
+def test_backlog_is_skipped():
+    buffer = InputBuffer(delay=2)
+    for sequence in range(1, 11):
+        buffer.add(sequence, sequence, [sequence, 0])
+    # only `delay * 2` are kept
+    assert buffer.next() == [7, 0]
+    assert buffer.skipped == 6
+    assert len(buffer) == 3
+
+
+def test_sequence_wraps_around():
+    buffer = InputBuffer(delay=2)
+    sequences = [MAX_SEQUENCE_NUMBER - 1, MAX_SEQUENCE_NUMBER, 0, 1]
+    # arriving out of order across the wrap
+    for sequence in (sequences[1], sequences[0], sequences[3], sequences[2]):
+        buffer.add(sequence, 0, [sequence, 0])
+    assert [buffer.next()[0] for _ in range(4)] == sequences
+    # anything from before the wrap is now stale
+    assert not buffer.add(MAX_SEQUENCE_NUMBER, 0, [0, 0])
+    assert buffer.add(2, 0, [2, 0])
@@ -0,0 +1,77 @@
+# Tests for reliable delivery: ReliableSender and ReceivedSequences.
+#
+#   python -m pytest test_reliable.py
+#
+from server import ReliableSender, ReceivedSequences
+
+CLIENT = ("127.0.0.1", 9000)
+
+
+def test_ack_bits_acks_the_marked_sequences():
+    sender = ReliableSender(max_sequence=1000)
+    for sequence in range(10, 20):
+        sender.add(CLIENT, sequence, b'x', 0.0)
+    # 19, and 18 and 16 (bits 1 and 3)
+    assert sender.ack_bits(CLIENT, 19, 0b101, 0.1) == 3
+    assert len(sender) == 7
+    # acking again changes nothing
+    assert sender.ack_bits(CLIENT, 19, 0b101, 0.1) == 0
+
+
+def test_ack_bits_wraps_around():
+    sender = ReliableSender(max_sequence=1000)
+    for sequence in (997, 998, 999, 0, 1):
+        sender.add(CLIENT, sequence, b'x', 0.0)
+    # 1, then 0, 999, 998 and 997 before it
+    assert sender.ack_bits(CLIENT, 1, 0b1111, 0.1) == 5
+    assert len(sender) == 0
+
+
+def test_unacked_packets_are_resent_then_given_up():
+    sender = ReliableSender(initial_rto=1.0, max_rto=4.0, max_retries=2)
+    sender.add(CLIENT, 1, b'x', 0.0)
+    assert sender.due(0.5) == []
+    assert [packet.sequence for packet in sender.due(1.0)] == [1]
+    assert [packet.sequence for packet in sender.due(10.0)] == [1]
+    assert sender.due(20.0) == []
+    assert sender.gave_up == 1
+    assert len(sender) == 0
+
+
+def test_received_sequences_bits():
+    received = ReceivedSequences(max_sequence=1000)
+    for sequence in (5, 6, 8):
+        received.received(sequence)
+    # 8, with 7 missing and 6 and 5 arrived
+    assert received.ack_payload() == [8, 0b110]
+    # 7 arrives late
+    received.received(7)
+    assert received.ack_payload() == [8, 0b111]
+    # a duplicate changes nothing
+    received.received(8)
+    assert received.ack_payload() == [8, 0b111]
+
+
+def test_received_sequences_wrap_around():
+    received = ReceivedSequences(max_sequence=1000)
+    for sequence in (998, 999, 0, 1):
+        received.received(sequence)
+    assert received.ack_payload() == [1, 0b111]
+    # a late one from before the wrap
+    received.received(997)
+    assert received.ack_payload() == [1, 0b1111]
+
+
+def test_received_sequences_drive_the_sender():
+    sender = ReliableSender(max_sequence=1000)
+    received = ReceivedSequences(max_sequence=1000)
+    for i in range(40):
+        sequence = (980 + i) % 1000
+        sender.add(CLIENT, sequence, b'x', 0.0)
+        if i % 7 != 3:
+            received.received(sequence)
+    sender.ack_bits(CLIENT, *received.ack_payload(), 0.1)
+    # only the ones that never arrived are still pending, apart from what
+    # fell out of the 32 sequence window
+    pending = sorted(packet.sequence for packet in sender.due(100.0))
+    assert pending == sorted({(980 + i) % 1000 for i in range(40) if i % 7 == 3 or i < 40 - 33})
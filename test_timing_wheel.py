@@ -0,0 +1,94 @@
+# Tests for the heartbeat TimingWheel.
+#
+#   python -m pytest test_timing_wheel.py
+#
+import threading
+from server import TimingWheel
+
+
+def test_keys_expire_at_their_deadline():
+    wheel = TimingWheel(resolution=0.25, slots=16)
+    wheel.touch("a", 1.0)
+    wheel.touch("b", 2.0)
+    assert wheel.expire(0.9) == []
+    assert wheel.expire(1.0) == ["a"]
+    assert "a" not in wheel and "b" in wheel
+    assert wheel.expire(2.5) == ["b"]
+    assert len(wheel) == 0
+
+
+def test_touch_pushes_the_deadline_back():
+    wheel = TimingWheel(resolution=0.25, slots=16)
+    wheel.touch("a", 1.0)
+    wheel.touch("a", 3.0)
+    assert wheel.expire(1.5) == []
+    # further out than the wheel goes round
+    wheel.touch("a", 20.0)
+    assert wheel.expire(10.0) == []
+    assert wheel.expire(20.0) == ["a"]
+
+
+def test_removed_keys_never_expire():
+    wheel = TimingWheel(resolution=0.25, slots=16)
+    wheel.touch("a", 1.0)
+    wheel.remove("a")
+    wheel.remove("a")
+    assert wheel.expire(5.0) == []
+
+
+def test_deadline_in_the_past_expires_next_time():
+    wheel = TimingWheel(resolution=0.25, slots=16)
+    wheel.expire(10.0)
+    wheel.touch("a", 5.0)
+    assert wheel.expire(10.25) == ["a"]
+
+
+def test_long_gap_between_expires():
+    wheel = TimingWheel(resolution=0.25, slots=16)
+    for i in range(100):
+        wheel.touch(i, i * 0.1)
+    assert sorted(wheel.expire(1000.0)) == list(range(100))
+
+
+def test_expire_racing_touch():
+    # one thread keeps pushing deadlines out while another expires: a key
+    # may only expire if the last deadline it was given has passed, and the
+    # wheel has to stay consistent
+    wheel = TimingWheel(resolution=0.01, slots=8)
+    keys = range(50)
+    now = [0.0]
+    deadlines = {}
+    for key in keys:
+        wheel.touch(key, 0.5)
+        deadlines[key] = 0.5
+    errors = []
+    stop = threading.Event()
+
+    def toucher():
+        try:
+            while not stop.is_set():
+                for key in keys:
+                    deadline = now[0] + 0.5
+                    wheel.touch(key, deadline)
+                    deadlines[key] = deadline
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=toucher)
+    thread.start()
+    try:
+        for _ in range(5000):
+            current = now[0]
+            # deadlines only move out, and are noted after the touch, so
+            # one noted before expire() is never later than the wheel's
+            before = dict(deadlines)
+            for key in wheel.expire(current):
+                assert before[key] <= current
+            now[0] += 0.001
+    finally:
+        stop.set()
+        thread.join()
+    assert errors == []
+    for key in keys:
+        wheel.touch(key, now[0])
+    assert sorted(wheel.expire(now[0] + 1.0)) == list(keys)